@@ -0,0 +1,161 @@
+# brasforma_batch.py
+# Pacotes do Comitê Semanal sem Streamlit: KPIs, RFM, Pareto/ABC e auditoria
+# de margem negativa para a base toda e para cada Representante e Regional.
+#
+# Uso:
+#   python brasforma_batch.py "Dashboard - Comite Semanal.xlsx" --saida pacotes_comite
+#   python brasforma_batch.py pasta_com_planilhas/ --de 2024-01-01 --ate 2024-12-31 --somente-alterados
+#
+# A base é carregada uma vez (mesmo cache Parquet do dashboard), compactada
+# (textos viram dicionários) e gravada em um arquivo Arrow sem compressão;
+# cada processo mapeia esse arquivo em memória em vez de receber uma cópia do
+# frame, e só os dicionários de texto são materializados por processo.
+import argparse
+import json
+import multiprocessing
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from brasforma_core import (
+    FilterEngine, _arrow_safe, apply_filters, calc_kpis, classify, compact_frame, compute_rfm, fold_text, load_many,
+    pa, prepare_many, read_prepared, trim_categories,
+)
+
+SLICE_FILTERS = {"Representante": "rep", "Regional": "reg", "UF": "uf", "Status de Produção / Faturamento": "stat"}
+# muda quando o conteúdo dos pacotes muda: força regravar com --somente-alterados
+PACKAGE_FORMAT = 2
+AUDIT_COLS = ["Nome Cliente","Pedido","ITEM","Representante","UF","Valor Pedido R$","Custo","Custo Total","Lucro Bruto","Margem %","Data do Pedido","Data / Mês"]
+
+def slug(v):
+    return re.sub(r"[^0-9a-z]+", "-", fold_text(v)).strip("-") or "vazio"
+
+def expand_sources(entries):
+    out = []
+    for e in map(Path, entries):
+        if e.is_dir():
+            files = [f for f in e.glob("*.xlsx") if not f.name.startswith("~$")]
+            out += [str(f) for f in sorted(files, key=lambda f: f.stat().st_mtime)]
+        else:
+            out.append(str(e))
+    return out
+
+def slice_fingerprint(df, filters, tiers):
+    # linhas da fatia + tudo o que muda a saída para as mesmas linhas
+    h = pd.util.hash_pandas_object(df, index=False).to_numpy().sum(dtype=np.uint64) if len(df) else 0
+    return f"v{PACKAGE_FORMAT}-t{tiers}-{filters.get('d_ini')}-{filters.get('d_fim')}-{len(df)}-{int(h):016x}"
+
+def _json_num(v):
+    return None if v is None or pd.isna(v) else float(v)
+
+# ---------------- Processos ----------------
+_ENGINE = None
+
+def _init_worker(base_path):
+    global _ENGINE
+    table = pa.ipc.open_file(pa.memory_map(base_path, "r")).read_all()
+    # split_blocks: colunas numéricas sem nulos viram views do arquivo mapeado;
+    # as de texto chegam como dicionário e viram categóricas (só códigos)
+    _ENGINE = FilterEngine(table.to_pandas(split_blocks=True))
+
+def run_slice(task):
+    dim, value, filters, out_dir, changed_only, tiers = task
+    out_dir = Path(out_dir)
+    flt = apply_filters(_ENGINE, **filters)
+    fp = slice_fingerprint(flt, filters, tiers)
+    kpi_path = out_dir / "kpis.json"
+    if changed_only and kpi_path.exists() and json.loads(kpi_path.read_text()).get("fingerprint") == fp:
+        return dim, value, "inalterado", len(flt)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    fat, n_ped, n_cli, n_sku, ticket, lucro, margem_w, pct_rentavel = calc_kpis(flt)
+    summary = {
+        "dimensao": dim, "valor": value, "linhas": int(len(flt)),
+        "filtros": {k: (list(v) if isinstance(v, tuple) else v) for k, v in filters.items()},
+        "faturamento": _json_num(fat), "pedidos": int(n_ped), "clientes": _json_num(n_cli), "skus": _json_num(n_sku),
+        "ticket_medio": _json_num(ticket), "lucro_bruto": _json_num(lucro), "margem_pond_pct": _json_num(margem_w),
+        "pct_itens_rentaveis": _json_num(pct_rentavel),
+        "pct_linhas_negativas": _json_num(100.0*(flt["Lucro Bruto"]<0).mean()) if "Lucro Bruto" in flt.columns and len(flt) else None,
+        "fingerprint": fp, "gerado_em": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    if "Nome Cliente" in flt.columns and len(flt):
+        ref_date = pd.to_datetime(filters["d_fim"]) if filters.get("d_fim") is not None else None
+        rfm = compute_rfm(flt, ref_date=ref_date, tiers=tiers)
+        trim_categories(rfm).to_parquet(out_dir / "rfm.parquet", index=False)
+        summary["rfm_segmentos"] = {k: int(n) for k, n in rfm["Segmento"].value_counts().items()}
+    if "Valor Pedido R$" in flt.columns:
+        for name, col in [("pareto_clientes", "Nome Cliente"), ("pareto_itens", "ITEM")]:
+            if col in flt.columns:
+                g = classify(flt, col, "Valor Pedido R$", filters.get("d_ini"), filters.get("d_fim"))
+                trim_categories(g).to_parquet(out_dir / f"{name}.parquet", index=False)
+                summary[f"{name}_classes"] = {k: int(n) for k, n in g["ABC"].value_counts().sort_index().items()}
+                summary[f"{name}_abc_xyz"] = {k: int(n) for k, n in g["Classe"].value_counts().sort_index().items()}
+    if "Lucro Bruto" in flt.columns:
+        neg = flt[flt["Lucro Bruto"] < 0]
+        trim_categories(neg[[c for c in AUDIT_COLS if c in neg.columns]]).to_parquet(out_dir / "margem_negativa.parquet", index=False)
+    kpi_path.write_text(json.dumps(summary, ensure_ascii=False, indent=2, default=str))
+    return dim, value, "gerado", len(flt)
+
+# ---------------- CLI ----------------
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Gera os pacotes do Comitê por Representante e Regional, sem o dashboard.")
+    ap.add_argument("entradas", nargs="+", help="planilhas .xlsx ou pastas com planilhas")
+    ap.add_argument("--saida", default="pacotes_comite", help="pasta de saída (padrão: pacotes_comite)")
+    ap.add_argument("--aba", default="Carteira de Vendas")
+    ap.add_argument("--de", help="início do período (AAAA-MM-DD)")
+    ap.add_argument("--ate", help="fim do período (AAAA-MM-DD)")
+    ap.add_argument("--dimensoes", nargs="+", default=["Representante","Regional"], choices=list(SLICE_FILTERS))
+    ap.add_argument("--processos", type=int, default=None, help="processos em paralelo (padrão: nº de CPUs)")
+    ap.add_argument("--somente-alterados", action="store_true", help="só regrava fatias cujas linhas mudaram")
+    ap.add_argument("--quintis", action="store_true", help="scores RFM de 1 a 5")
+    args = ap.parse_args(argv)
+
+    sources = expand_sources(args.entradas)
+    if not sources:
+        ap.error("nenhuma planilha encontrada")
+    keys, _ = prepare_many(sources, args.aba, max_workers=args.processos)
+    df = read_prepared(keys[0]) if len(keys) == 1 else load_many(keys)
+
+    out = Path(args.saida)
+    out.mkdir(parents=True, exist_ok=True)
+    base_path = out / "_base.arrow"
+    with pa.OSFile(str(base_path), "wb") as sink:
+        table = pa.Table.from_pandas(compact_frame(_arrow_safe(df)[0])[0], preserve_index=False)
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    d_ini = pd.Timestamp(args.de).date() if args.de else None
+    d_fim = pd.Timestamp(args.ate).date() if args.ate else None
+    if (d_ini is None) != (d_fim is None):
+        ap.error("--de e --ate devem ser usados juntos")
+    base_filters = {"d_ini": d_ini, "d_fim": d_fim}
+    tiers = 5 if args.quintis else 3
+    tasks = [("Geral", None, base_filters, str(out / "geral"), args.somente_alterados, tiers)]
+    for dim in args.dimensoes:
+        if dim not in df.columns:
+            continue
+        for v in sorted(df[dim].dropna().unique()):
+            tasks.append((dim, v, {**base_filters, SLICE_FILTERS[dim]: (v,)}, str(out / slug(dim) / slug(v)), args.somente_alterados, tiers))
+    del df, table
+
+    t0 = time.perf_counter()
+    results = []
+    try:
+        with ProcessPoolExecutor(max_workers=args.processos, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker, initargs=(str(base_path),)) as ex:
+            for dim, value, status, rows in ex.map(run_slice, tasks, chunksize=4):
+                results.append({"dimensao": dim, "valor": value, "status": status, "linhas": rows})
+    finally:
+        base_path.unlink(missing_ok=True)
+    (out / "manifest.json").write_text(json.dumps({"fontes": sources, "fatias": results}, ensure_ascii=False, indent=2, default=str))
+    n_new = sum(r["status"] == "gerado" for r in results)
+    print(f"{len(results)} fatias ({n_new} geradas, {len(results)-n_new} inalteradas) em {time.perf_counter()-t0:.1f}s -> {out}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+# brasforma_bench.py
+# Gerador de "Carteira de Vendas" sintética (mesmo esquema que load_data
+# espera) e benchmark de tempo e pico de memória das etapas do dashboard.
+#
+# Uso:
+#   python brasforma_bench.py --linhas 10k 100k 1m --saida bench.json
+#   python brasforma_bench.py --linhas 100k --gerar-xlsx dados/      # só grava a planilha
+#   python brasforma_bench.py --comparar bench_antigo.json bench.json
+#
+# Acima de --xlsx-max linhas a planilha não é gravada (o Excel comporta ~1M de
+# linhas e o openpyxl leva minutos nessa escala); nesses tamanhos mede-se
+# prepare_data sobre o frame bruto, que é o que load_data faz após a leitura.
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from brasforma_core import (
+    ABC_MEASURES, FilterEngine, SalesCube, apply_filters, calc_kpis, classify, compact_frame, compute_rfm, load_data, pa,
+    prepare_data, write_export,
+)
+
+# ---------------- Gerador sintético ----------------
+UF_PESOS = {
+    "SP": 30, "MG": 10, "RJ": 8, "PR": 7, "RS": 7, "SC": 6, "BA": 5, "GO": 4, "PE": 3, "CE": 3, "ES": 2, "DF": 2,
+    "MT": 2, "MS": 2, "PA": 2, "AM": 1, "MA": 1, "PB": 1, "RN": 1, "AL": 1, "PI": 1, "SE": 1, "TO": 0.5,
+    "RO": 0.5, "AC": 0.2, "AP": 0.2, "RR": 0.2,
+}
+UF_REGIONAL = {
+    **dict.fromkeys(["SP","MG","RJ","ES"], "Sudeste"), **dict.fromkeys(["PR","RS","SC"], "Sul"),
+    **dict.fromkeys(["GO","DF","MT","MS"], "Centro-Oeste"),
+    **dict.fromkeys(["BA","PE","CE","MA","PB","RN","AL","PI","SE"], "Nordeste"),
+    **dict.fromkeys(["PA","AM","TO","RO","AC","AP","RR"], "Norte"),
+}
+NOME_PREFIXO = ["Comércio", "Distribuidora", "Indústria", "Casa", "Mercado", "Atacadão", "Construtora", "Ferragens",
+                "Depósito", "Madeireira", "Loja", "Center"]
+NOME_MEIO = ["Silva", "Souza", "Oliveira", "Santos", "Pereira", "Lima", "Carvalho", "Ribeiro", "Almeida", "Gonçalves",
+             "Araújo", "Rocha", "Barbosa", "Moraes", "São João", "Boa Vista", "Paraná", "Ipiranga", "Horizonte",
+             "Aurora", "Estrela", "União", "Progresso", "Real"]
+NOME_SUFIXO = ["Ltda", "ME", "S.A.", "EIRELI", "Ltda - EPP"]
+STATUS_PESOS = {"Faturado": 0.70, "Em produção": 0.18, "Aguardando": 0.08, "Cancelado": 0.04}
+PRAZO_DIAS = 30
+_CENTS = np.array([f"{i:02d}" for i in range(100)], dtype=object)
+
+def _zipf_p(k, s):
+    w = 1.0 / np.arange(1, k + 1) ** s
+    return w / w.sum()
+
+# Valores no formato da planilha: "1.234,56" (parte com prefixo "R$ ").
+def br_money(v, rng, pct_rs=0.05):
+    cents = np.round(np.abs(v) * 100).astype(np.int64)
+    reais, cent = np.divmod(cents, 100)
+    codes, uniq = pd.factorize(reais)
+    grp = pd.Series(uniq).map("{:,}".format).str.replace(",", ".", regex=False).to_numpy(dtype=object)
+    out = grp[codes] + "," + _CENTS[cent]
+    out[v < 0] = "-" + out[v < 0]
+    rs = rng.random(len(v)) < pct_rs
+    out[rs] = "R$ " + out[rs]
+    return out
+
+def synthetic_carteira(n, seed=0, start="2023-01-01", months=36):
+    """Frame bruto como lido da aba "Carteira de Vendas", com n linhas."""
+    rng = np.random.default_rng(seed)
+    n_cli = int(np.clip(n / 40, 200, 250_000))
+    n_sku = int(np.clip(n / 200, 300, 60_000))
+    n_rep = int(np.clip(np.sqrt(n) / 4, 20, 300))
+
+    # clientes: UF ponderada, representante com carteira desigual
+    ufs = np.array(list(UF_PESOS))
+    cli_uf = rng.choice(ufs, n_cli, p=np.array(list(UF_PESOS.values())) / sum(UF_PESOS.values()))
+    cli_rep = rng.choice(n_rep, n_cli, p=_zipf_p(n_rep, 0.6))
+    ids = np.arange(n_cli)
+    cli_nome = np.array([f"{NOME_PREFIXO[i % 12]} {NOME_MEIO[(i // 12) % 24]} {i:06d} {NOME_SUFIXO[(i * 7) % 5]}" for i in ids], dtype=object)
+    reps = np.array([f"Rep {i:03d}" for i in range(n_rep)], dtype=object)
+    skus = np.array([f"SKU-{i:05d}" for i in range(n_sku)], dtype=object)
+    sku_preco = rng.lognormal(3.5, 1.0, n_sku)
+    sku_custo = sku_preco * rng.uniform(0.45, 0.95, n_sku)
+
+    # pedidos: ~3 linhas cada, cliente com cauda longa, sazonalidade e crescimento
+    sizes = rng.geometric(1 / 3, n // 2 + 10)
+    sizes = sizes[: np.searchsorted(np.cumsum(sizes), n) + 1]
+    n_ped = len(sizes)
+    ped_cli = rng.choice(n_cli, n_ped, p=_zipf_p(n_cli, 0.8))
+    mes_w = np.linspace(1.0, 1.4, months) * (1 + 0.25 * np.sin(np.arange(months) * 2 * np.pi / 12))
+    ped_mes = rng.choice(months, n_ped, p=mes_w / mes_w.sum())
+    ped_data = (pd.Timestamp(start) + pd.to_timedelta(ped_mes * 30.44 + rng.uniform(0, 30, n_ped), unit="D")).normalize()
+    ped_status = rng.choice(list(STATUS_PESOS), n_ped, p=list(STATUS_PESOS.values()))
+    ped_lead = np.round(rng.gamma(3, 9, n_ped)).astype(int) + 1
+
+    row_ped = np.repeat(np.arange(n_ped), sizes)[:n]
+    cli = ped_cli[row_ped]
+    sku = rng.choice(n_sku, n, p=_zipf_p(n_sku, 0.9))
+    qtde = rng.geometric(0.08, n)
+    desconto = np.where(rng.random(n) < 0.06, rng.uniform(0.4, 0.7, n), rng.uniform(0.0, 0.15, n))
+    valor = sku_preco[sku] * qtde * (1 - desconto)
+    data = ped_data[row_ped]
+    lead = ped_lead[row_ped]
+    status = ped_status[row_ped]
+    entrega = pd.Series(data + pd.to_timedelta(lead, unit="D"))
+    entrega[np.isin(status, ["Aguardando", "Cancelado"])] = pd.NaT
+
+    df = pd.DataFrame({
+        "Pedido": 100000 + row_ped,
+        "Data / Mês": data,
+        "Data do Pedido": data,
+        "Data da Entrega": entrega.to_numpy(),
+        "Nome Cliente": cli_nome[cli],
+        "Regional": pd.Series(cli_uf[cli]).map(UF_REGIONAL).to_numpy(dtype=object),
+        "UF": cli_uf[cli].astype(object),
+        "Representante": reps[cli_rep[cli]],
+        "ITEM": skus[sku],
+        "Status de Produção / Faturamento": status.astype(object),
+        "Atrasado / No prazo": np.where(lead > PRAZO_DIAS, "Atrasado", "No prazo").astype(object),
+        "Valor Pedido R$": br_money(valor, rng),
+        "Qtde": qtde,
+        "Custo": br_money(sku_custo[sku], rng),
+    })
+    # lacunas e sujeira típicas da planilha
+    for col, frac in [("Custo", 0.01), ("Valor Pedido R$", 0.002), ("Data da Entrega", 0.005), ("Representante", 0.002)]:
+        df.loc[rng.random(n) < frac, col] = None
+    df.loc[rng.random(n) < 0.0005, "Custo"] = "-"
+    df.loc[rng.random(n) < 0.0005, "Valor Pedido R$"] = ""
+    return df
+
+def parse_rows(s):
+    s = s.strip().lower()
+    mult = {"k": 1_000, "m": 1_000_000}.get(s[-1], 1)
+    return int(float(s[:-1] if mult > 1 else s) * mult)
+
+# ---------------- Medição ----------------
+def measure(fn, setup=None, repeats=3):
+    """Tempos de `repeats` execuções e pico de memória (tracemalloc) de uma execução extra."""
+    times = []
+    for _ in range(repeats):
+        arg = setup() if setup else None
+        t0 = time.perf_counter()
+        fn(arg) if setup else fn()
+        times.append(time.perf_counter() - t0)
+    arg = setup() if setup else None
+    tracemalloc.start()
+    try:
+        result = fn(arg) if setup else fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"tempo_min_s": min(times), "tempo_mediana_s": float(np.median(times)), "execucoes_s": times,
+            "pico_mem_mb": peak / 1024**2}, result
+
+def filter_combos(df):
+    """Combinações típicas do sidebar."""
+    d_max = df["Data / Mês"].max().date()
+    d_3m = (df["Data / Mês"].max() - pd.DateOffset(months=3)).date()
+    top_reg = df["Regional"].value_counts().index[0]
+    top_rep = tuple(df["Representante"].value_counts().index[:2])
+    return {
+        "periodo_3m": dict(d_ini=d_3m, d_fim=d_max),
+        "regional": dict(reg=(top_reg,)),
+        "rep_uf": dict(rep=top_rep, uf=("SP",)),
+        "cliente_texto": dict(cliente="comercio"),
+        "combinado": dict(d_ini=d_3m, d_fim=d_max, stat=("Faturado",), item="sku-00", show_neg=True),
+    }
+
+# Mesmos agrupamentos da aba de rentabilidade.
+def profit_tables(df):
+    out = [df.groupby(dim, observed=True)["Lucro Bruto"].sum().nlargest(20) for dim in ["Nome Cliente","ITEM"]]
+    for dim in ["Representante","UF","Nome Cliente"]:
+        g = df.groupby(dim, as_index=False, observed=True)[["Lucro Bruto","Valor Pedido R$"]].sum()
+        g["Margem %"] = np.where(g["Valor Pedido R$"]>0, 100.0*g["Lucro Bruto"]/g["Valor Pedido R$"], np.nan)
+        out.append(g)
+    out.append(df[df["Lucro Bruto"] < 0])
+    return out
+
+def pareto_tables(df):
+    return [classify(df, col, m) for col in ["Nome Cliente","ITEM"] for m in ABC_MEASURES]
+
+def bench_size(n, args, log):
+    results = []
+    modo = "normal"
+    def record(stage, fn, setup=None, **extra):
+        stats, out = measure(fn, setup, args.repeticoes)
+        results.append({"linhas": n, "modo": modo, "etapa": stage, **stats, **extra})
+        log(f"  {stage:<28} {modo:<8} {stats['tempo_mediana_s']:>9.3f}s  {stats['pico_mem_mb']:>9.1f} MB")
+        return out
+
+    t0 = time.perf_counter()
+    raw = synthetic_carteira(n, seed=args.seed)
+    log(f"{n:,} linhas geradas em {time.perf_counter()-t0:.1f}s")
+    if n <= args.xlsx_max:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "carteira.xlsx")
+            raw.to_excel(path, sheet_name="Carteira de Vendas", index=False)
+            record("load_data", lambda: load_data(path))
+    df, _ = record("prepare_data", prepare_data, setup=raw.copy)
+    del raw
+    frames = [("normal", df)]
+    if args.compacto:
+        compact, _ = record("compact_frame", lambda: compact_frame(df))
+        frames.append(("compacto", compact))
+
+    for modo, df in frames:
+        record("FilterEngine", lambda: FilterEngine(df))
+        for name, filters in filter_combos(df).items():
+            flt = record(f"apply_filters[{name}]", lambda e: apply_filters(e, **filters), setup=lambda: FilterEngine(df))
+            results[-1]["linhas_saida"] = len(flt)
+        record("SalesCube", lambda: SalesCube(df))
+        record("calc_kpis", lambda: calc_kpis(df))
+        record("compute_rfm", lambda: compute_rfm(df))
+        record("profit_groupbys", lambda: profit_tables(df))
+        record("pareto_abc_xyz", lambda: pareto_tables(df))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "export.csv")
+            record("export_csv", lambda: write_export(df, "csv", path))
+            results[-1]["bytes_saida"] = os.path.getsize(path)
+    return results
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent, timeout=10).stdout.strip() or None
+    except Exception:
+        commit = None
+    return {
+        "gerado_em": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit, "python": platform.python_version(),
+        "pandas": pd.__version__, "numpy": np.__version__, "pyarrow": pa.__version__ if pa is not None else None,
+        "plataforma": platform.platform(), "cpus": os.cpu_count(),
+    }
+
+# ---------------- Comparação ----------------
+def compare(old_path, new_path, tolerance):
+    old, new = (json.loads(Path(p).read_text()) for p in (old_path, new_path))
+    # resultados anteriores ao campo "modo" foram todos medidos no frame normal
+    base = {(r["linhas"], r.get("modo", "normal"), r["etapa"]): r for r in old["resultados"]}
+    worse = 0
+    print(f"{'linhas':>10}  {'etapa':<28} {'modo':<8} {'antes':>9} {'depois':>9} {'razão':>7} {'mem antes':>10} {'mem depois':>10}")
+    for r in new["resultados"]:
+        o = base.get((r["linhas"], r.get("modo", "normal"), r["etapa"]))
+        if o is None:
+            continue
+        ratio = r["tempo_mediana_s"] / o["tempo_mediana_s"] if o["tempo_mediana_s"] > 0 else float("nan")
+        flag = " *" if ratio > tolerance else ""
+        worse += bool(flag)
+        print(f"{r['linhas']:>10,}  {r['etapa']:<28} {r.get('modo', 'normal'):<8} {o['tempo_mediana_s']:>8.3f}s {r['tempo_mediana_s']:>8.3f}s "
+              f"{ratio:>6.2f}x {o['pico_mem_mb']:>8.1f}MB {r['pico_mem_mb']:>8.1f}MB{flag}")
+    if worse:
+        print(f"{worse} etapa(s) mais de {tolerance:.2f}x mais lentas (*)")
+    return 1 if worse else 0
+
+# ---------------- CLI ----------------
+def log(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark do Dashboard Comercial sobre uma Carteira de Vendas sintética.")
+    ap.add_argument("--linhas", nargs="+", default=["10k","100k"], help="tamanhos, ex.: 10k 100k 1m 10m")
+    ap.add_argument("--saida", default="bench.json", help="arquivo JSON de resultados (padrão: bench.json)")
+    ap.add_argument("--repeticoes", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--xlsx-max", type=parse_rows, default=100_000,
+                    help="maior tamanho em que load_data lê uma planilha real (padrão: 100k)")
+    ap.add_argument("--compacto", action="store_true", help="mede as etapas também com o frame em modo compacto (campo modo)")
+    ap.add_argument("--gerar-xlsx", metavar="PASTA", help="só grava as planilhas sintéticas nesta pasta")
+    ap.add_argument("--comparar", nargs=2, metavar=("ANTES", "DEPOIS"), help="compara dois arquivos de resultados")
+    ap.add_argument("--tolerancia", type=float, default=1.25, help="razão de tempo acima da qual a etapa é marcada")
+    args = ap.parse_args(argv)
+
+    if args.comparar:
+        return compare(*args.comparar, args.tolerancia)
+    sizes = [parse_rows(s) for s in args.linhas]
+    if args.gerar_xlsx:
+        out = Path(args.gerar_xlsx)
+        out.mkdir(parents=True, exist_ok=True)
+        for n in sizes:
+            path = out / f"carteira_sintetica_{n}.xlsx"
+            synthetic_carteira(n, seed=args.seed).to_excel(path, sheet_name="Carteira de Vendas", index=False)
+            print(path)
+        return 0
+
+    report = {"ambiente": environment(), "parametros": {"repeticoes": args.repeticoes, "seed": args.seed,
+              "compacto": args.compacto}, "resultados": []}
+    for n in sizes:
+        report["resultados"] += bench_size(n, args, log)
+        Path(args.saida).write_text(json.dumps(report, ensure_ascii=False, indent=2))  # parcial a cada tamanho
+    log(f"resultados em {args.saida}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1454 @@
+# brasforma_core.py
+# Camada de dados do Dashboard Comercial, sem dependência do Streamlit:
+# leitura e preparação da planilha, cache Parquet, ingestão incremental,
+# carga de várias planilhas em paralelo, filtros, KPIs, RFM/ABC, exportação e
+# perfil de execução.
+import gzip
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # sem pyarrow o cache em disco fica desativado
+    pa = pq = None
+
+# ---------------- Conversão numérica ----------------
+def to_num(x):
+    if pd.isna(x):
+        return np.nan
+    if isinstance(x, (int, float, np.integer, np.floating)):
+        return float(x)
+    s = str(x).replace("R$", "").strip().replace(".", "").replace(",", ".")
+    try:
+        return float(s)
+    except Exception:
+        return np.nan
+
+# Versão vetorizada de to_num: converte a coluna inteira de uma vez.
+# Retorna (serie_float, n_falhas) — falhas = células preenchidas que viraram NaN.
+def to_num_series(s):
+    if pd.api.types.is_bool_dtype(s) or pd.api.types.is_numeric_dtype(s):
+        return s.astype(float), 0
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return pd.Series(np.nan, index=s.index), int(s.notna().sum())
+    obj = s.astype(object)
+    txt = obj.str.strip()  # NaN onde a célula não é texto
+    is_txt = txt.notna()
+    out = pd.to_numeric(obj.where(~is_txt), errors="coerce").astype(float)
+    if is_txt.any():
+        # converte só os valores distintos (bases repetem muito os mesmos valores)
+        codes, uniq = pd.factorize(txt[is_txt])
+        clean = (pd.Series(uniq, dtype=object)
+                 .str.replace("R$", "", regex=False).str.strip()
+                 .str.replace(".", "", regex=False).str.replace(",", ".", regex=False))
+        parsed = pd.to_numeric(clean, errors="coerce").to_numpy(dtype=float)
+        out[is_txt] = parsed[codes]
+    filled = obj.notna() & ~(is_txt & (txt == ""))
+    return out, int((filled & out.isna()).sum())
+
+# ---------------- Texto ----------------
+def fold_text(s):
+    s = unicodedata.normalize("NFKD", str(s).casefold())
+    return "".join(ch for ch in s if not unicodedata.combining(ch))
+
+
+# ---------------- Harmonização de colunas ----------------
+# Planilhas de semanas/anos diferentes trazem variações de nome de coluna;
+# todas são levadas ao nome usado pelo dashboard.
+COLUMN_ALIASES = {
+    "Nome Cliente": ["Nome do Cliente", "Cliente", "Razão Social"],
+    "ITEM": ["Item", "SKU", "Cód. Item", "Codigo Item"],
+    "Pedido": ["Nº Pedido", "Num Pedido", "Número do Pedido"],
+    "Representante": ["Vendedor", "Rep."],
+    "Regional": ["Região"],
+    "UF": ["Estado"],
+    "Valor Pedido R$": ["Valor Pedido", "Valor do Pedido", "Valor Pedido (R$)", "Vlr Pedido R$"],
+    "Custo": ["Custo Unitário", "Custo Unit."],
+    "Data / Mês": ["Data/Mês", "Data Mês", "Mês"],
+    "Data do Pedido": ["Dt Pedido", "Data Pedido"],
+    "Data da Entrega": ["Dt Entrega", "Data Entrega"],
+    "Status de Produção / Faturamento": ["Status de Produção/Faturamento", "Status Prod./Fat.", "Status"],
+    "Atrasado / No prazo": ["Atrasado/No prazo", "Atraso"],
+}
+
+def _col_norm(c):
+    return re.sub(r"[^0-9a-z$]", "", fold_text(c))
+
+_ALIAS_LOOKUP = {_col_norm(a): canon for canon, aliases in COLUMN_ALIASES.items() for a in [canon] + aliases}
+
+def harmonize_columns(df):
+    ren = {}
+    for c in df.columns:
+        canon = _ALIAS_LOOKUP.get(_col_norm(c))
+        if canon and canon != c and canon not in df.columns and canon not in ren.values():
+            ren[c] = canon
+    return df.rename(columns=ren) if ren else df
+
+# ---------------- Load & prep ----------------
+class WorkbookError(Exception):
+    pass
+
+def read_workbook(path, sheet_name="Carteira de Vendas"):
+    try:
+        xls = pd.ExcelFile(path, engine="openpyxl")
+    except Exception as e:
+        raise WorkbookError("Falha ao abrir Excel. Verifique .xlsx e dependência openpyxl.") from e
+    df = pd.read_excel(xls, sheet_name=sheet_name)
+    df.columns = [c.strip() for c in df.columns]
+    return harmonize_columns(df)
+
+def load_data(path: str, sheet_name="Carteira de Vendas"):
+    return prepare_data(read_workbook(path, sheet_name))
+
+# Conversões e colunas derivadas sobre a planilha bruta (altera df).
+def prepare_data(df):
+    for col in ["Data / Mês","Data Final","Data do Pedido","Data da Entrega","Data Inserção"]:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], errors="coerce")
+
+    parse_fail = {}
+    for col in ["Valor Pedido R$","TICKET MÉDIO","Quant. Pedidos","Custo"]:
+        if col in df.columns:
+            if col == "Quant. Pedidos":
+                df[col] = pd.to_numeric(df[col], errors="coerce")
+            else:
+                df[col], parse_fail[col] = to_num_series(df[col])
+
+    if "Data / Mês" in df.columns:
+        df["Ano"] = df["Data / Mês"].dt.year
+        df["Mes"] = df["Data / Mês"].dt.month
+        df["Ano-Mes"] = df["Data / Mês"].dt.to_period("M").astype(str)
+
+    if "Data do Pedido" in df.columns and "Data da Entrega" in df.columns:
+        df["LeadTime (dias)"] = (df["Data da Entrega"] - df["Data do Pedido"]).dt.days
+
+    if "Atrasado / No prazo" in df.columns:
+        df["AtrasadoFlag"] = df["Atrasado / No prazo"].astype(str).str.contains("Atras", case=False, na=False)
+
+    # COST: unitário x quantidade (auto-detect; fallback para coluna M)
+    qty_candidates = ["Qtde","QTDE","Quantidade","Quantidade Pedido","Qtd","QTD","Quant.","Quant","Qde","QTD.","QTD PEDIDA","QTD PEDIDO","QTD SOLICITADA","QTD Solicitada"]
+    qty_col = None
+    for c in qty_candidates:
+        if c in df.columns:
+            qty_col = c; break
+    if qty_col is None:
+        try:
+            qty_col = df.columns[12]  # fallback para coluna M
+        except Exception:
+            qty_col = None
+
+    if "Custo" in df.columns:
+        # "Custo" já foi convertido acima; só a quantidade ainda precisa de parse
+        if qty_col is not None:
+            if qty_col not in parse_fail:
+                df[qty_col], parse_fail[qty_col] = to_num_series(df[qty_col])
+            df["Custo Total"] = df["Custo"] * df[qty_col]
+        else:
+            df["Custo Total"] = df["Custo"]
+    else:
+        df["Custo Total"] = np.nan
+
+    if "Valor Pedido R$" in df.columns:
+        df["Lucro Bruto"] = df["Valor Pedido R$"] - df["Custo Total"]
+        df["Margem %"] = np.where(df["Valor Pedido R$"]>0, 100*df["Lucro Bruto"]/df["Valor Pedido R$"], np.nan)
+
+    if "Pedido" in df.columns and "ITEM" in df.columns:
+        df["PedidoItemKey"] = df["Pedido"].astype(str) + "||" + df["ITEM"].astype(str)
+
+    df.attrs["parse_fail"] = {c: n for c, n in parse_fail.items() if n}
+    return df, qty_col
+
+# ---------------- Cache colunar (Parquet) ----------------
+# O frame já preparado por load_data é gravado em Parquet particionado por
+# "Ano-Mes", sob uma chave = hash do conteúdo do workbook + CACHE_VERSION.
+CACHE_DIR = Path(os.environ.get("BRASFORMA_CACHE_DIR", ".cache_brasforma"))
+CACHE_VERSION = "v4"  # incremente sempre que a preparação em load_data mudar
+CACHE_MAX_BYTES = int(float(os.environ.get("BRASFORMA_CACHE_MAX_GB", "2")) * 1024**3)
+CACHE_MAX_AGE_DAYS = float(os.environ.get("BRASFORMA_CACHE_MAX_AGE_DAYS", "30"))
+FILTER_DIMS = ["Regional","Representante","UF","Status de Produção / Faturamento"]
+MONEY_COLS = ["Valor Pedido R$","TICKET MÉDIO","Custo","Custo Total","Lucro Bruto"]
+PCT_COLS = ["Margem %"]
+
+CACHE_STATS = {"hit": 0, "miss": 0}  # por processo
+
+def cache_stats():
+    return CACHE_STATS
+
+@lru_cache(maxsize=64)
+def _path_hash(path, mtime, size):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def workbook_key(src, sheet_name="Carteira de Vendas"):
+    if hasattr(src, "getvalue"):
+        digest = hashlib.sha256(src.getvalue()).hexdigest()
+    else:
+        try:
+            stt = os.stat(src)
+        except OSError as e:
+            raise WorkbookError("Falha ao abrir Excel. Verifique .xlsx e dependência openpyxl.") from e
+        digest = _path_hash(str(src), stt.st_mtime_ns, stt.st_size)
+    sheet = hashlib.sha256(sheet_name.encode()).hexdigest()[:8]
+    return f"{digest[:32]}-{sheet}-{CACHE_VERSION}"
+
+def dataset_meta(df, qty_col):
+    meta = {
+        "qty_col": qty_col,
+        "columns": list(df.columns),
+        "rows": int(len(df)),
+        "parse_fail": df.attrs.get("parse_fail", {}),
+        "options": {c: sorted(df[c].dropna().unique()) for c in FILTER_DIMS if c in df.columns},
+    }
+    if "Data / Mês" in df.columns:
+        meta["min_date"] = str(df["Data / Mês"].min())
+        meta["max_date"] = str(df["Data / Mês"].max())
+    return meta
+
+def _arrow_safe(df):
+    # colunas object com tipos misturados (ex.: Pedido numérico e texto) não
+    # convertem para Arrow; nesses casos os valores não nulos viram texto
+    out, coerced = df, []
+    for c in df.columns:
+        if df[c].dtype == object and pd.api.types.infer_dtype(df[c], skipna=True) in ("mixed", "mixed-integer"):
+            if not coerced:
+                out = df.copy()
+            out[c] = df[c].where(df[c].isna(), df[c].astype(str))
+            coerced.append(c)
+    return out, coerced
+
+def trim_categories(df):
+    # categorias sem uso iriam inteiras no dicionário Arrow (navegador, Parquet)
+    cats = {c: df[c].cat.remove_unused_categories() for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)}
+    return df.assign(**cats) if cats else df
+
+def _dir_size(d):
+    return sum(f.stat().st_size for f in d.rglob("*") if f.is_file())
+
+# entradas do cache não mudam depois de gravadas (a chave é o hash do
+# conteúdo): tamanho, metadados e diferenças entre cargas valem pela chave
+@lru_cache(maxsize=256)
+def _entry_bytes(key):
+    return _dir_size(CACHE_DIR / key)
+
+def cache_entries():
+    if not CACHE_DIR.exists():
+        return []
+    out = []
+    for d in CACHE_DIR.iterdir():
+        m = d / "_meta.json"
+        if d.is_dir() and m.exists():
+            out.append({"key": d.name, "path": d, "last_used": m.stat().st_mtime, "bytes": _entry_bytes(d.name)})
+    return out
+
+def evict_cache(max_bytes=CACHE_MAX_BYTES, max_age_days=CACHE_MAX_AGE_DAYS, keep=None):
+    now = time.time()
+    if CACHE_DIR.exists():  # restos de gravações interrompidas
+        for d in CACHE_DIR.glob(".tmp-*"):
+            if now - d.stat().st_mtime > 86400:
+                shutil.rmtree(d, ignore_errors=True)
+    entries = sorted(cache_entries(), key=lambda e: e["last_used"])
+    total = sum(e["bytes"] for e in entries)
+    for e in entries:
+        if e["key"] == keep:
+            continue
+        if now - e["last_used"] > max_age_days * 86400 or total > max_bytes:
+            shutil.rmtree(e["path"], ignore_errors=True)
+            total -= e["bytes"]
+
+# ---------------- Ingestão incremental ----------------
+# Cada entrada do cache guarda também _rows.parquet: uma chave por linha
+# (hash de Pedido||ITEM + ocorrência) e o hash da linha bruta. Uma planilha
+# nova é comparada com a carga anterior e só as linhas inseridas ou
+# alteradas passam por prepare_data; as demais vêm prontas do snapshot.
+def row_keys(raw):
+    k = raw["Pedido"].astype(str) + "||" + raw["ITEM"].astype(str)
+    occ = k.groupby(k).cumcount()  # Pedido||ITEM repetido na mesma planilha
+    keys = pd.util.hash_pandas_object(pd.DataFrame({"k": k, "n": occ}), index=False).to_numpy()
+    hashes = pd.util.hash_pandas_object(raw, index=False).to_numpy()
+    return pd.DataFrame({"__chave__": keys, "__hash__": hashes})
+
+def snapshot_rows(key):
+    return pq.read_table(CACHE_DIR / key / "_rows.parquet").to_pandas()
+
+def latest_snapshot(key, raw_columns):
+    suffix = key.split("-", 1)[1]  # mesma aba e mesma CACHE_VERSION
+    best = None
+    for e in cache_entries():
+        if e["key"] == key or not e["key"].endswith(suffix) or not (e["path"] / "_rows.parquet").exists():
+            continue
+        meta = json.loads((e["path"] / "_meta.json").read_text())
+        if meta.get("raw_columns") == raw_columns and (best is None or meta["created"] > best[1]):
+            best = (e["key"], meta["created"])
+    return best[0] if best else None
+
+def diff_rows(old, new):
+    pos = pd.Index(old["__chave__"]).get_indexer(new["__chave__"])
+    found = pos >= 0
+    same = found.copy()
+    same[found] = old["__hash__"].to_numpy()[pos[found]] == new["__hash__"].to_numpy()[found]
+    removed = ~old["__chave__"].isin(new["__chave__"]).to_numpy()
+    return pos, same, ~found, found & ~same, removed
+
+def ingest_incremental(raw, rows, base_key):
+    pos, same, inserted, changed, removed = diff_rows(snapshot_rows(base_key), rows)
+    old = read_prepared(base_key)
+    kept = old.iloc[pos[same]]
+    kept.index = np.flatnonzero(same)
+    if same.all():
+        df, qty_col = kept, json.loads((CACHE_DIR / base_key / "_meta.json").read_text())["qty_col"]
+        df.attrs["parse_fail"] = {}
+    else:
+        fresh, qty_col = prepare_data(raw.iloc[np.flatnonzero(~same)].copy())
+        fresh.index = np.flatnonzero(~same)
+        df = pd.concat([kept, fresh]).sort_index() if len(kept) else fresh
+        df.attrs["parse_fail"] = fresh.attrs.get("parse_fail", {})
+    delta = {"base": base_key, "inseridas": int(inserted.sum()), "alteradas": int(changed.sum()),
+             "removidas": int(removed.sum()), "mantidas": int(same.sum())}
+    return df.reset_index(drop=True), qty_col, delta
+
+def write_prepared(df, qty_col, key, rows=None, extra=None):
+    final = CACHE_DIR / key
+    tmp = CACHE_DIR / f".tmp-{key}-{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    out, coerced = _arrow_safe(df)
+    out = out.assign(**{"__linha__": np.arange(len(out), dtype=np.int64)})  # ordem original da planilha
+    table = pa.Table.from_pandas(out, preserve_index=False)
+    if "Ano-Mes" in out.columns:
+        pq.write_to_dataset(table, tmp, partition_cols=["Ano-Mes"])
+    else:
+        pq.write_table(table, tmp / "part-0.parquet")
+    meta = dataset_meta(df, qty_col)
+    meta["coerced"] = coerced
+    meta["created"] = time.time()
+    meta.update(extra or {})
+    if rows is not None:
+        pq.write_table(pa.Table.from_pandas(rows, preserve_index=False), tmp / "_rows.parquet")
+    (tmp / "_meta.json").write_text(json.dumps(meta, ensure_ascii=False, default=lambda o: o.item() if hasattr(o, "item") else str(o)))
+    try:
+        os.replace(tmp, final)
+    except OSError:  # outra sessão gravou a mesma chave primeiro
+        shutil.rmtree(tmp, ignore_errors=True)
+    evict_cache(keep=key)
+    return meta
+
+def prepared_meta(src, key, incremental=True, sheet_name="Carteira de Vendas"):
+    m = CACHE_DIR / key / "_meta.json"
+    if m.exists():
+        return json.loads(m.read_text())
+    cache_stats()["miss"] += 1
+    raw = read_workbook(src, sheet_name)
+    extra = {"raw_columns": list(raw.columns)}
+    rows = row_keys(raw) if {"Pedido","ITEM"}.issubset(raw.columns) else None
+    base_key = latest_snapshot(key, extra["raw_columns"]) if incremental and rows is not None else None
+    if base_key is not None:
+        df, qty_col, extra["delta"] = ingest_incremental(raw, rows, base_key)
+    else:
+        df, qty_col = prepare_data(raw)
+    return write_prepared(df, qty_col, key, rows=rows, extra=extra)
+
+@lru_cache(maxsize=256)
+def _snapshot_info(key):
+    meta = json.loads((CACHE_DIR / key / "_meta.json").read_text())
+    if "created" not in meta:
+        return None
+    return {"key": key, "created": meta["created"], "rows": meta["rows"], "delta": meta.get("delta")}
+
+def snapshot_history(entries=None):
+    out = [_snapshot_info(e["key"]) for e in (cache_entries() if entries is None else entries)]
+    return sorted((s for s in out if s is not None), key=lambda s: s["created"], reverse=True)
+
+@lru_cache(maxsize=32)
+def snapshot_diff(key_a, key_b):
+    # diferença entre duas cargas só pelas chaves/hashes, sem reler dados
+    _, _, inserted, changed, removed = diff_rows(snapshot_rows(key_a), snapshot_rows(key_b))
+    return {"inseridas": int(inserted.sum()), "alteradas": int(changed.sum()), "removidas": int(removed.sum())}
+
+def read_prepared(key):
+    path = CACHE_DIR / key
+    meta = json.loads((path / "_meta.json").read_text())
+    os.utime(path / "_meta.json")  # marca uso para a evicção LRU
+    cache_stats()["hit"] += 1
+    table = pq.read_table(path, memory_map=True)
+    order = np.argsort(table.column("__linha__").to_numpy(), kind="stable")
+    df = table.take(order).to_pandas()
+    if "Ano-Mes" in df.columns:
+        df["Ano-Mes"] = df["Ano-Mes"].astype(str)
+    df.index = pd.Index(df.pop("__linha__").to_numpy())
+    df = df[meta["columns"]]
+    df.attrs["parse_fail"] = meta["parse_fail"]
+    return df
+
+
+# ---------------- Várias planilhas ----------------
+# Cada planilha tem sua própria entrada no cache; só as que faltam são
+# preparadas, em paralelo (openpyxl é CPU-bound e single-thread).
+def _prepare_worker(src, key, sheet_name):
+    if isinstance(src, bytes):
+        src = io.BytesIO(src)
+    return key, prepared_meta(src, key, incremental=False, sheet_name=sheet_name)
+
+def prepare_many(sources, sheet_name="Carteira de Vendas", max_workers=None, keys=None):
+    keys = list(keys) if keys is not None else [workbook_key(s, sheet_name) for s in sources]
+    metas = {}
+    todo = []
+    for s, k in zip(sources, keys):
+        m = CACHE_DIR / k / "_meta.json"
+        if m.exists():
+            metas[k] = json.loads(m.read_text())
+        else:
+            todo.append((s.getvalue() if hasattr(s, "getvalue") else str(s), k))
+    if len(todo) == 1:
+        k, metas[todo[0][1]] = _prepare_worker(todo[0][0], todo[0][1], sheet_name)
+    elif todo:
+        workers = min(len(todo), max_workers or os.cpu_count() or 1)
+        # spawn: o servidor do Streamlit tem várias threads, fork não é seguro
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as ex:
+            for k, m in ex.map(_prepare_worker, *zip(*todo), [sheet_name] * len(todo)):
+                metas[k] = m
+        CACHE_STATS["miss"] += len(todo)
+    return keys, [metas[k] for k in keys]
+
+def merge_meta(metas):
+    out = {"qty_col": next((m["qty_col"] for m in metas if m["qty_col"]), None),
+           "columns": list(dict.fromkeys(c for m in metas for c in m["columns"])),
+           "rows": sum(m["rows"] for m in metas),
+           "parse_fail": {}, "options": {}}
+    for m in metas:
+        for c, n in m["parse_fail"].items():
+            out["parse_fail"][c] = out["parse_fail"].get(c, 0) + n
+        for c, vals in m["options"].items():
+            out["options"].setdefault(c, set()).update(vals)
+    out["options"] = {c: sorted(v) for c, v in out["options"].items()}
+    dates = [(m["min_date"], m["max_date"]) for m in metas if "min_date" in m and m["min_date"] != "NaT"]
+    if dates:
+        out["min_date"] = str(min(pd.Timestamp(a) for a, _ in dates))
+        out["max_date"] = str(max(pd.Timestamp(b) for _, b in dates))
+    return out
+
+def merge_frames(frames):
+    # frames do mais antigo ao mais recente; em PedidoItemKey repetido entre
+    # arquivos vale o arquivo mais recente (duplicatas dentro dele são mantidas)
+    df = pd.concat(frames, ignore_index=True)
+    if "PedidoItemKey" in df.columns and len(frames) > 1:
+        src = np.repeat(np.arange(len(frames)), [len(f) for f in frames])
+        codes, uniq = pd.factorize(df["PedidoItemKey"])
+        last = np.full(len(uniq), -1)
+        np.maximum.at(last, codes[codes >= 0], src[codes >= 0])
+        keep = (codes < 0) | (src == last[codes])
+        df = df[keep].reset_index(drop=True)
+    return df
+
+def load_many(keys):
+    frames = [read_prepared(k) for k in keys]
+    df = merge_frames(frames)
+    for f in frames:
+        for c, n in f.attrs.get("parse_fail", {}).items():
+            df.attrs.setdefault("parse_fail", {})[c] = df.attrs.get("parse_fail", {}).get(c, 0) + n
+    return df
+
+# ---------------- Bases em memória ----------------
+# Um DatasetStore por processo (DATASETS) guarda cada base carregada uma única
+# vez e a entrega, sem cópia, a todas as sessões do Streamlit. Cada sessão
+# conta como referência da base que usa (e solta a anterior ao trocar); acima
+# do orçamento saem primeiro as bases sem sessões, da menos recente para a
+# mais recente. O tamanho de cada base é medido de novo a cada acquire (size),
+# pois motores crescem com cubo e caches depois da carga. Referências expiram
+# após session_ttl sem uso, porque o Streamlit não avisa quando uma sessão fecha.
+STORE_MAX_BYTES = int(float(os.environ.get("BRASFORMA_STORE_MAX_GB", "4")) * 1024**3)
+STORE_SESSION_TTL = float(os.environ.get("BRASFORMA_STORE_SESSION_TTL_MIN", "30")) * 60
+
+def frame_nbytes(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+class DatasetStore:
+    def __init__(self, max_bytes=STORE_MAX_BYTES, session_ttl=STORE_SESSION_TTL):
+        self.max_bytes = max_bytes
+        self.session_ttl = session_ttl
+        self._entries = OrderedDict()  # key -> {"value", "size", "bytes", "refs": {sessão: último uso}}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, session, loader, size=frame_nbytes):
+        """Valor de `key`, criado por loader() uma só vez mesmo com sessões
+        concorrentes. O valor é compartilhado: trate-o como somente leitura."""
+        # a referência da sessão entra na mesma seção que encontra a entrada:
+        # entre as duas, outra sessão poderia despejar a base
+        key_lock = None
+        with self._lock:
+            value = self._use(key, session)
+            if value is None:
+                key_lock = self._loading.setdefault(key, threading.Lock())
+        if key_lock is not None:
+            with key_lock:
+                with self._lock:
+                    value = self._use(key, session)
+                if value is None:
+                    value = loader()
+                    nbytes = size(value)
+                    with self._lock:
+                        self._entries[key] = {"value": value, "size": size, "bytes": nbytes, "refs": {}}
+                        self._use(key, session)
+        self._evict()
+        return value
+
+    def _use(self, key, session):
+        # chamado com self._lock; None se a base não está carregada
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        for k, e in self._entries.items():
+            if k != key:
+                e["refs"].pop(session, None)
+        entry["refs"][session] = time.time()
+        self._entries.move_to_end(key)
+        return entry["value"]
+
+    def release(self, session):
+        with self._lock:
+            for e in self._entries.values():
+                e["refs"].pop(session, None)
+
+    def _evict(self):
+        # medir fora do lock: size() pode tomar locks da própria base e
+        # percorrer a memória dela, e isso não deve parar as outras sessões
+        with self._lock:
+            entries = list(self._entries.items())
+        sizes = {k: (e, e["size"](e["value"])) for k, e in entries}
+        with self._lock:
+            now = time.time()
+            total = 0
+            for k, e in self._entries.items():
+                for s, seen in list(e["refs"].items()):
+                    if now - seen > self.session_ttl:
+                        del e["refs"][s]
+                if k in sizes and sizes[k][0] is e:
+                    e["bytes"] = sizes[k][1]
+                total += e["bytes"]
+            for k in list(self._entries):
+                if total <= self.max_bytes:
+                    break
+                e = self._entries[k]
+                if not e["refs"]:
+                    total -= e["bytes"]
+                    del self._entries[k]
+                    self._loading.pop(k, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._loading.clear()
+
+    def stats(self):
+        with self._lock:
+            return [{"key": k, "bytes": e["bytes"], "sessoes": len(e["refs"])} for k, e in self._entries.items()]
+
+DATASETS = DatasetStore()
+
+# ---------------- Busca textual ----------------
+# Os filtros "contém" buscam nos valores distintos (clientes/SKUs), já sem
+# acentos e em caixa baixa, e depois chegam às linhas pelos códigos.
+class TextIndex:
+    def __init__(self, values, max_queries=256):
+        self.codes, self.values = pd.factorize(values)
+        self.folded = (pd.Series(self.values.astype(str), dtype=object)
+                       .str.casefold().str.normalize("NFKD")
+                       .str.replace(r"[\u0300-\u036f]", "", regex=True)).to_numpy(dtype=object)
+        self.freq = np.bincount(self.codes[self.codes >= 0], minlength=len(self.values))
+        self._base_bytes = (self.codes.nbytes + self.freq.nbytes
+                            + int(pd.Series(self.folded, dtype=object).memory_usage(index=False, deep=True)))
+        self._hits = {}
+        self._max_queries = max_queries
+        self._lock = threading.Lock()
+
+    def match(self, text):
+        q = fold_text(text)
+        with self._lock:
+            hit = self._hits.get(q)
+            # quem contém q também contém qualquer trecho de q: parte do menor resultado já conhecido
+            base = min((ids for prev, ids in self._hits.items() if prev in q), key=len, default=None)
+        if hit is not None:
+            return hit
+        cand = np.arange(len(self.folded)) if base is None else base
+        found = pd.Series(self.folded[cand], dtype=object).str.contains(q, regex=False).to_numpy(dtype=bool)
+        hit = cand[found]
+        with self._lock:
+            if len(self._hits) >= self._max_queries:
+                self._hits.pop(next(iter(self._hits)), None)
+            self._hits[q] = hit
+        return hit
+
+    def nbytes(self):
+        with self._lock:
+            return self._base_bytes + sum(h.nbytes for h in self._hits.values())
+
+    def row_mask(self, text):
+        sel = np.zeros(len(self.values) + 1, dtype=bool)  # posição extra: código -1 (vazio)
+        sel[self.match(text)] = True
+        return sel[self.codes]
+
+    def suggest(self, text, k=5):
+        ids = self.match(text)
+        if len(ids) == 0:
+            return []
+        pos = pd.Series(self.folded[ids], dtype=object).str.find(fold_text(text)).to_numpy()
+        order = np.lexsort((-self.freq[ids], pos))  # começo do nome primeiro, depois os mais frequentes
+        return list(self.values[ids[order[:k]]])
+
+# ---------------- Motor de filtros ----------------
+# Construído uma vez por base: códigos categóricos das dimensões, índice
+# ordenado de "Data / Mês" (busca binária) e máscaras booleanas num LRU
+# limitado (por valor, período, texto e combinação de valores).
+# Cada combinação de filtros vira poucos ANDs de máscaras booleanas.
+def _filter_key(filters):
+    return tuple(sorted((k, tuple(v) if isinstance(v, (list, tuple)) else v) for k, v in filters.items()))
+
+class FilterEngine:
+    def __init__(self, df, max_results=8, max_masks=32, df_bytes=None):
+        self.df = df
+        self.n = len(df)
+        self._codes, self._lookup = {}, {}
+        for c in FILTER_DIMS:
+            if c in df.columns:
+                codes, cats = pd.factorize(df[c])
+                self._codes[c] = codes
+                self._lookup[c] = {v: i for i, v in enumerate(cats)}
+        if "Data / Mês" in df.columns:
+            dates = df["Data / Mês"].to_numpy(dtype="datetime64[ns]").view("i8")
+            self._date_order = np.argsort(dates, kind="stable")
+            self._date_sorted = dates[self._date_order]  # NaT (mínimo int64) fica no início
+        self._text = {}
+        self._measures = {}
+        self._masks = OrderedDict()
+        self._max_masks = max_masks
+        self._results = OrderedDict()
+        self._max_results = max_results
+        self._lock = threading.Lock()
+        self._cube_lock = threading.Lock()  # o cubo leva segundos: não segura os caches
+        self._cube = None
+        self._derived = OrderedDict()
+        self._df_bytes = df_bytes  # memory_usage(deep) da base; medido no primeiro nbytes se None
+
+    @property
+    def cube(self):
+        if self._cube is None:
+            with self._cube_lock:
+                if self._cube is None:
+                    self._cube = SalesCube(self.df)
+        return self._cube
+
+    def nbytes(self):
+        """Memória da base mais índices, cubo e caches do motor. Frames em
+        cache contam só os próprios arrays (os textos são os da base)."""
+        if self._df_bytes is None:
+            self._df_bytes = frame_nbytes(self.df)
+        with self._lock:
+            masks = list(self._masks.values())
+            frames = [r for r in self._results.values() if r is not self.df]
+            frames += [d for d in self._derived.values() if isinstance(d, pd.DataFrame)]
+        total = self._df_bytes + sum(m.nbytes for m in masks) + sum(c.nbytes for c in self._codes.values())
+        total += sum(int(f.memory_usage(index=True).sum()) for f in frames)
+        total += sum(ix.nbytes() for ix in list(self._text.values()))
+        total += sum(v.nbytes for v in list(self._measures.values()))
+        if "Data / Mês" in self.df.columns:
+            total += self._date_order.nbytes + self._date_sorted.nbytes
+        if self._cube is not None:
+            total += self._cube.nbytes()
+        return total
+
+    def _cached(self, key, build):
+        # cada máscara ocupa n bytes: LRU limitado, reconstruir é barato
+        with self._lock:
+            if key in self._masks:
+                self._masks.move_to_end(key)
+                return self._masks[key]
+        m = build()
+        with self._lock:
+            self._masks[key] = m
+            while len(self._masks) > self._max_masks:
+                self._masks.popitem(last=False)
+        return m
+
+    def date_rows(self, d_ini, d_fim):
+        # posições (em ordem de data) das linhas entre d_ini e d_fim, sem máscara
+        lo = np.searchsorted(self._date_sorted, pd.Timestamp(d_ini).as_unit("ns").value, side="left")
+        hi = np.searchsorted(self._date_sorted, pd.Timestamp(d_fim).as_unit("ns").value, side="right")
+        return self._date_order[lo:hi]
+
+    def date_mask(self, d_ini, d_fim):
+        def build():
+            m = np.zeros(self.n, dtype=bool)
+            m[self.date_rows(d_ini, d_fim)] = True
+            return m
+        return self._cached(("date", d_ini, d_fim), build)
+
+    def value_mask(self, col, value):
+        def build():
+            code = self._lookup[col].get(value, -2)  # -2 nunca ocorre: máscara vazia
+            return self._codes[col] == code
+        return self._cached((col, value), build)
+
+    def isin_mask(self, col, values):
+        if len(set(values)) == 1:
+            return self.value_mask(col, next(iter(values)))
+        def build():
+            codes = [self._lookup[col][v] for v in set(values) if v in self._lookup[col]]
+            return np.isin(self._codes[col], codes)
+        return self._cached((col, frozenset(values)), build)
+
+    def text_index(self, col):
+        ix = self._text.get(col)
+        if ix is None:
+            ix = self._text[col] = TextIndex(self.df[col])
+        return ix
+
+    def contains_mask(self, col, text):
+        return self._cached(("contains", col, fold_text(text)), lambda: self.text_index(col).row_mask(text))
+
+    def measure(self, col):
+        # medida como float sem NaN, copiada uma vez para as somas por intervalo
+        v = self._measures.get(col)
+        if v is None:
+            v = self._measures[col] = np.nan_to_num(self.df[col].to_numpy(dtype=float))
+        return v
+
+    def neg_mask(self):
+        return self._cached(("neg",), lambda: (self.df["Lucro Bruto"] < 0).to_numpy())
+
+    def row_index(self, **filters):
+        m = self.row_mask(**filters)
+        return None if m is None else np.flatnonzero(m)
+
+    def row_mask(self, d_ini=None, d_fim=None, reg=(), rep=(), uf=(), stat=(), cliente="", item="", show_neg=False):
+        masks = []
+        if d_ini is not None and "Data / Mês" in self.df.columns:
+            masks.append(self.date_mask(d_ini, d_fim))
+        for col, values in zip(FILTER_DIMS, (reg, rep, uf, stat)):
+            if values:
+                masks.append(self.isin_mask(col, values))
+        if cliente:
+            masks.append(self.contains_mask("Nome Cliente", cliente))
+        if item:
+            masks.append(self.contains_mask("ITEM", item))
+        if show_neg and "Lucro Bruto" in self.df.columns:
+            masks.append(self.neg_mask())
+        if not masks:
+            return None
+        m = masks[0].copy()
+        for other in masks[1:]:
+            m &= other
+        return m
+
+    def _memo(self, key, build):
+        # resultados derivados (séries, classes) em LRU próprio, maior que o de filtros
+        with self._lock:
+            if key in self._derived:
+                self._derived.move_to_end(key)
+                return self._derived[key]
+        out = build()
+        with self._lock:
+            self._derived[key] = out
+            while len(self._derived) > 4 * self._max_results:
+                self._derived.popitem(last=False)
+        return out
+
+    def series(self, freq="M", **filters):
+        """Somas por período (time_series) de todas as datas, para os demais
+        filtros; mudar só o período reaproveita a mesma série."""
+        base = {k: v for k, v in filters.items() if k not in ("d_ini", "d_fim")}
+        def build():
+            idx = self.row_index(**base)
+            return time_series(self.df if idx is None else self.df.take(idx), freq)
+        return self._memo(("serie", freq) + _filter_key(base), build)
+
+    def classes(self, dim, measure="Valor Pedido R$", **filters):
+        """classify() de `dim` por `measure` no estado de filtro; fica em
+        cache, então trocar de aba ou de sessão não reclassifica."""
+        return self._memo(("abc", dim, measure) + _filter_key(filters),
+                          lambda: classify(self.filter(**filters), dim, measure, filters.get("d_ini"), filters.get("d_fim")))
+
+    def class_cross(self, measure="Valor Pedido R$", **filters):
+        """Matriz classe de cliente × classe de SKU (cross_classes), em cache."""
+        def build():
+            return cross_classes(self.filter(**filters), self.classes("Nome Cliente", measure, **filters),
+                                 self.classes("ITEM", measure, **filters), measure)
+        return self._memo(("abc_cruz", measure) + _filter_key(filters), build)
+
+    def filter(self, **filters):
+        key = _filter_key(filters)
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                return self._results[key]
+        idx = self.row_index(**filters)
+        # sem filtro efetivo devolve o próprio frame (somente leitura, sem cópia)
+        out = self.df if idx is None or len(idx) == self.n else self.df.take(idx)
+        with self._lock:
+            self._results[key] = out
+            while len(self._results) > self._max_results:
+                self._results.popitem(last=False)
+        return out
+
+# ---------------- Cubo agregado ----------------
+# Somas e contagens na granularidade Ano-Mes × Regional × Representante × UF ×
+# Status × Cliente × ITEM, mais os pares (célula, Pedido) distintos para contar
+# pedidos exatos. Responde KPIs e rankings sem reler as linhas, exceto quando
+# há filtro "contém", de margem negativa ou período que corta um mês ao meio.
+CUBE_DIMS = ["Ano-Mes"] + FILTER_DIMS + ["Nome Cliente","ITEM"]
+CUBE_MEASURES = ["Valor Pedido R$","Lucro Bruto","Custo Total"]
+
+class SalesCube:
+    def __init__(self, df):
+        self.columns = set(df.columns)
+        self.dims = [c for c in CUBE_DIMS if c in df.columns]
+        self.measures = [c for c in CUBE_MEASURES if c in df.columns]
+        self.labels, self.lookup, keys = {}, {}, {}
+        for c in self.dims:
+            keys[c], self.labels[c] = pd.factorize(df[c])
+            self.lookup[c] = {v: i for i, v in enumerate(self.labels[c])}
+        keys = pd.DataFrame(keys, index=df.index)
+        cell = keys.groupby(self.dims, sort=False).ngroup().to_numpy() if self.dims else np.zeros(len(df), dtype=np.int64)
+
+        vals = pd.DataFrame({c: df[c].to_numpy() for c in self.measures})
+        vals["Linhas"] = 1
+        if "Lucro Bruto" in df.columns:
+            vals["Positivas"] = (df["Lucro Bruto"] > 0).to_numpy()
+            vals["Negativas"] = (df["Lucro Bruto"] < 0).to_numpy()
+        self.cells = vals.groupby(cell).sum()
+        if self.dims:
+            self.cells = self.cells.join(pd.DataFrame(keys.to_numpy(), columns=self.dims).groupby(cell).first())
+
+        self._pair_cell = self._pair_ped = None
+        if "Pedido" in df.columns:
+            ped, _ = pd.factorize(df["Pedido"])
+            ok = ped >= 0
+            base = np.int64(ped.max() + 1) if ok.any() else np.int64(1)
+            pairs = np.unique(cell[ok].astype(np.int64) * base + ped[ok])
+            self._pair_cell, self._pair_ped = pairs // base, pairs % base
+
+        self._month_bounds = None
+        if "Ano-Mes" in self.dims and "Data / Mês" in df.columns:
+            dates = pd.Series(df["Data / Mês"].to_numpy(), index=keys.index)
+            self._month_bounds = dates.groupby(keys["Ano-Mes"].to_numpy()).agg(["min","max"])
+
+    def nbytes(self):
+        # rótulos compartilham os textos da base: só os ponteiros contam
+        total = int(self.cells.memory_usage(index=True).sum())
+        total += sum(lab.nbytes + sys.getsizeof(self.lookup[c]) for c, lab in self.labels.items())
+        if self._pair_cell is not None:
+            total += self._pair_cell.nbytes + self._pair_ped.nbytes
+        return total
+
+    def cell_mask(self, d_ini=None, d_fim=None, reg=(), rep=(), uf=(), stat=(), cliente="", item="", show_neg=False):
+        # None = o cubo não responde esta combinação; use as linhas
+        if cliente or item or show_neg:
+            return None
+        m = np.ones(len(self.cells), dtype=bool)
+        if d_ini is not None and "Data / Mês" in self.columns:
+            if self._month_bounds is None:
+                return None
+            lo, hi = pd.Timestamp(d_ini), pd.Timestamp(d_fim)
+            b = self._month_bounds
+            inside = (b["min"] >= lo) & (b["max"] <= hi)
+            outside = b["min"].isna() | (b["max"] < lo) | (b["min"] > hi)
+            if not (inside | outside).all():
+                return None  # algum mês só parcialmente no período
+            m &= np.isin(self.cells["Ano-Mes"].to_numpy(), b.index[inside.to_numpy()])
+        for col, values in zip(FILTER_DIMS, (reg, rep, uf, stat)):
+            if values:
+                if col not in self.lookup:
+                    return None
+                codes = [self.lookup[col][v] for v in values if v in self.lookup[col]]
+                m &= np.isin(self.cells[col].to_numpy(), codes)
+        return m
+
+    def nunique(self, col, m):
+        if col == "Pedido":
+            return int(np.unique(self._pair_ped[m[self._pair_cell]]).size)
+        codes = self.cells[col].to_numpy()[m]
+        return int(np.unique(codes[codes >= 0]).size)
+
+    def totals(self, m):
+        return self.cells[m].sum()
+
+    def kpis(self, m):
+        # mesma saída de calc_kpis
+        tot = self.totals(m)
+        rows = int(tot["Linhas"])
+        fat = tot["Valor Pedido R$"] if "Valor Pedido R$" in self.columns else np.nan
+        n_ped = self.nunique("Pedido", m) if "Pedido" in self.columns else rows
+        n_cli = self.nunique("Nome Cliente", m) if "Nome Cliente" in self.columns else np.nan
+        n_sku = self.nunique("ITEM", m) if "ITEM" in self.columns else np.nan
+        ticket = (fat / n_ped) if (n_ped and n_ped>0) else np.nan
+        lucro = tot["Lucro Bruto"] if "Lucro Bruto" in self.columns else np.nan
+        margem_w = 100*(lucro/fat) if (pd.notna(lucro) and fat and fat>0) else np.nan
+        pct_rentavel = 100.0*tot["Positivas"]/rows if "Lucro Bruto" in self.columns and rows>0 else np.nan
+        return fat, n_ped, n_cli, n_sku, ticket, lucro, margem_w, pct_rentavel
+
+    def group_sum(self, dim, cols, m):
+        sel = self.cells.loc[m, [dim] + cols]
+        g = sel[sel[dim] >= 0].groupby(dim, as_index=False)[cols].sum()
+        g[dim] = self.labels[dim][g[dim].to_numpy()]
+        return g.sort_values(dim, ignore_index=True)
+
+# ---------------- Séries temporais ----------------
+# Somas por mês, semana (início na segunda) ou trimestre via bincount sobre o
+# código do período, com períodos vazios preenchidos com zero. A série de
+# todas as datas fica no FilterEngine por estado de filtro; series_window
+# recorta o período escolhido e recalcula só os períodos de borda parciais,
+# comparando-os com os mesmos dias do período anterior e do ano anterior.
+TS_MEASURES = ["Valor Pedido R$","Lucro Bruto","Custo Total"]
+TS_LAGS = {"M": 12, "W": 52, "Q": 4}  # períodos em um ano
+TS_STEPS = {"M": pd.DateOffset(months=1), "W": pd.DateOffset(weeks=1), "Q": pd.DateOffset(months=3)}
+TS_YEARS = {"M": pd.DateOffset(years=1), "W": pd.DateOffset(weeks=52), "Q": pd.DateOffset(years=1)}  # semanas: mesmos dias da semana
+
+def period_codes(dates, freq="M"):
+    d = np.asarray(dates, dtype="datetime64[D]")
+    months = d.astype("datetime64[M]").astype(np.int64)
+    if freq == "M":
+        codes = months
+    elif freq == "Q":
+        codes = months // 3
+    elif freq == "W":
+        codes = (d.astype(np.int64) + 3) // 7  # 1970-01-01 foi quinta-feira
+    else:
+        raise ValueError(f"Frequência desconhecida: {freq}")
+    return codes, ~np.isnat(d)
+
+def period_start(codes, freq="M"):
+    codes = np.asarray(codes, dtype=np.int64)
+    if freq == "W":
+        return pd.to_datetime((codes * 7 - 3).astype("datetime64[D]"))
+    months = codes * 3 if freq == "Q" else codes
+    return pd.to_datetime(months.astype("datetime64[M]"))
+
+def period_labels(codes, freq="M"):
+    start = period_start(codes, freq)
+    if freq == "M":
+        return start.strftime("%Y-%m")
+    if freq == "Q":
+        return [f"{t.year}-T{(t.month - 1) // 3 + 1}" for t in start]
+    return start.strftime("%d/%m/%Y")
+
+def time_series(df, freq="M"):
+    cols = ["Periodo","Inicio","Codigo","Linhas"] + TS_MEASURES
+    if "Data / Mês" not in df.columns or len(df) == 0:
+        return pd.DataFrame(columns=cols)
+    codes, valid = period_codes(df["Data / Mês"].to_numpy(), freq)
+    codes = codes[valid]
+    if len(codes) == 0:
+        return pd.DataFrame(columns=cols)
+    lo = codes.min()
+    pos = codes - lo
+    n = int(pos.max()) + 1
+    full = np.arange(lo, lo + n)
+    out = {"Periodo": period_labels(full, freq), "Inicio": period_start(full, freq), "Codigo": full,
+           "Linhas": np.bincount(pos, minlength=n)}
+    for c in TS_MEASURES:
+        if c in df.columns:
+            out[c] = np.bincount(pos, weights=np.nan_to_num(df[c].to_numpy(dtype=float)[valid]), minlength=n)
+    return pd.DataFrame(out)
+
+def _margin(lucro, valor):
+    return np.where(valor > 0, 100.0 * lucro / np.where(valor > 0, valor, 1), np.nan)
+
+def _pct_change(cur, prev):
+    return np.where(prev > 0, 100.0 * (cur - prev) / np.where(prev > 0, prev, 1), np.nan)
+
+def _range_sums(engine, mask, a, b):
+    # somas das medidas entre as datas a e b dentro de `mask` (demais filtros):
+    # busca binária no índice de datas, sem ocupar os LRUs de máscaras e frames
+    rows = engine.date_rows(a, b)
+    if mask is not None:
+        rows = rows[mask[rows]]
+    out = {"Linhas": len(rows)}
+    for c in TS_MEASURES:
+        if c in engine.df.columns:
+            out[c] = float(engine.measure(c)[rows].sum())
+    return out
+
+def series_window(engine, freq="M", periods=12, **filters):
+    """Últimos `periods` períodos do filtro atual com margem ponderada,
+    janelas móveis de 3 e 12 meses (só mensal) e variações sobre o período
+    anterior e o mesmo período do ano anterior. Períodos de borda cortados
+    pelo filtro de datas são comparados com os mesmos dias dos períodos de
+    referência, e suas janelas móveis terminam na data final do filtro.
+    Fica em cache no motor por estado de filtro: trate como somente leitura."""
+    return engine._memo(("janela", freq, periods) + _filter_key(filters),
+                        lambda: _series_window(engine, freq, periods, filters))
+
+def _series_window(engine, freq, periods, filters):
+    ts = engine.series(freq, **filters).reset_index(drop=True)
+    if not len(ts):
+        return ts
+    valor = ts["Valor Pedido R$"]
+    ts["Margem %"] = _margin(ts["Lucro Bruto"].to_numpy(), valor.to_numpy())
+    windows = (3, 12) if freq == "M" else ()
+    for w in windows:
+        rv = valor.rolling(w, min_periods=w).sum()
+        ts[f"Valor {w}M"] = rv
+        ts[f"Margem {w}M %"] = _margin(ts["Lucro Bruto"].rolling(w, min_periods=w).sum().to_numpy(), rv.to_numpy())
+    ts["Var. %"] = _pct_change(valor.to_numpy(), valor.shift(1).to_numpy())
+    ts["YoY %"] = _pct_change(valor.to_numpy(), valor.shift(TS_LAGS[freq]).to_numpy())
+    if filters.get("d_ini") is None:
+        return ts.tail(periods).reset_index(drop=True)
+
+    start, end = pd.Timestamp(filters["d_ini"]), pd.Timestamp(filters["d_fim"])
+    (lo, hi), _ = period_codes([start, end], freq)
+    nums = [c for c in TS_MEASURES + ["Linhas"] if c in ts.columns]
+    mask = None  # demais filtros, montada só se houver período de borda
+    for code in {lo, hi}:
+        row = np.flatnonzero(ts["Codigo"].to_numpy() == code)
+        p0, p1 = period_start([code, code + 1], freq)
+        a, b = max(start, p0), min(end, p1 - pd.Timedelta(days=1))
+        if not len(row) or (a == p0 and b == p1 - pd.Timedelta(days=1)):
+            continue  # período inteiro dentro do filtro
+        i = row[0]
+        if mask is None:
+            mask = engine.row_mask(**{k: v for k, v in filters.items() if k not in ("d_ini", "d_fim")})
+        cur = _range_sums(engine, mask, a, b)
+        ts.loc[i, nums] = [cur[c] for c in nums]
+        ts.loc[i, "Margem %"] = _margin(np.array([cur["Lucro Bruto"]]), np.array([cur["Valor Pedido R$"]]))[0]
+        prev = _range_sums(engine, mask, a - TS_STEPS[freq], b - TS_STEPS[freq])
+        ly = _range_sums(engine, mask, a - TS_YEARS[freq], b - TS_YEARS[freq])
+        ts.loc[i, "Var. %"] = _pct_change(np.array([cur["Valor Pedido R$"]]), np.array([prev["Valor Pedido R$"]]))[0]
+        ts.loc[i, "YoY %"] = _pct_change(np.array([cur["Valor Pedido R$"]]), np.array([ly["Valor Pedido R$"]]))[0]
+        for w in windows:
+            # janela de w meses terminando em b, não em fim de mês
+            win = _range_sums(engine, mask, b - pd.DateOffset(months=w) + pd.Timedelta(days=1), b)
+            ts.loc[i, f"Valor {w}M"] = win["Valor Pedido R$"]
+            ts.loc[i, f"Margem {w}M %"] = _margin(np.array([win["Lucro Bruto"]]), np.array([win["Valor Pedido R$"]]))[0]
+    ts = ts[(ts["Codigo"] >= lo) & (ts["Codigo"] <= hi)]
+    return ts.tail(periods).reset_index(drop=True)
+
+def shift_period(filters, years=-1):
+    """Mesmos filtros com o período deslocado em `years` anos; None sem
+    período ou quando o período deslocado se sobrepõe ao original."""
+    if filters.get("d_ini") is None:
+        return None
+    off = pd.DateOffset(years=years)
+    d_ini, d_fim = pd.Timestamp(filters["d_ini"]) + off, pd.Timestamp(filters["d_fim"]) + off
+    if d_fim >= pd.Timestamp(filters["d_ini"]) and d_ini <= pd.Timestamp(filters["d_fim"]):
+        return None
+    return {**filters, "d_ini": d_ini.date(), "d_fim": d_fim.date()}
+
+def period_kpis(engine, **filters):
+    cells = engine.cube.cell_mask(**filters)
+    if cells is not None:
+        return engine.cube.kpis(cells)
+    return calc_kpis(apply_filters(engine, **filters))
+
+# ---------------- Modo compacto ----------------
+# Dimensões textuais viram categóricas, PedidoItemKey vira hash de 64 bits,
+# inteiros e floats não monetários são reduzidos quando não há perda, e
+# Ano/Mes saem do frame; with_lazy_cols os recalcula sob demanda, junto com o
+# PedidoItemKey em texto, para prévia e exportação.
+CATEGORY_COLS = ["Nome Cliente","ITEM","Representante","Regional","UF","Status de Produção / Faturamento","Atrasado / No prazo","Ano-Mes"]
+LAZY_COLS = ["Ano","Mes"]
+
+def pedido_item_key(df):
+    keys = pd.DataFrame({"p": df["Pedido"].astype(str), "i": df["ITEM"].astype(str)})
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+def with_lazy_cols(df):
+    dates = "Data / Mês" in df.columns and "Ano" not in df.columns
+    key = ("PedidoItemKey" in df.columns and df["PedidoItemKey"].dtype == np.uint64
+           and "Pedido" in df.columns and "ITEM" in df.columns)
+    if not dates and not key:
+        return df
+    out = df.copy()
+    if key:  # hash do modo compacto volta ao texto "Pedido||ITEM"
+        out["PedidoItemKey"] = out["Pedido"].astype(str) + "||" + out["ITEM"].astype(str)
+    if dates:
+        loc = out.columns.get_loc("Ano-Mes") if "Ano-Mes" in out.columns else len(out.columns)
+        out.insert(loc, "Ano", out["Data / Mês"].dt.year)
+        out.insert(loc + 1, "Mes", out["Data / Mês"].dt.month)
+    return out
+
+def compact_frame(df):
+    before = df.memory_usage(index=False, deep=True)
+    out = df.drop(columns=[c for c in LAZY_COLS if c in df.columns])
+    for c in out.columns:
+        s = out[c]
+        if c == "PedidoItemKey":
+            out[c] = pedido_item_key(out)
+        elif s.dtype == object and (c in CATEGORY_COLS or s.nunique() < 0.5 * len(s)):
+            out[c] = s.astype("category")
+        elif pd.api.types.is_integer_dtype(s) and not pd.api.types.is_bool_dtype(s):
+            out[c] = pd.to_numeric(s, downcast="integer")
+        elif pd.api.types.is_float_dtype(s) and c not in MONEY_COLS + CUBE_MEASURES + PCT_COLS:
+            # somas de valores ficam em float64; demais só se o float32 for exato
+            s32 = s.astype(np.float32)
+            if ((s32.astype(np.float64) == s) | s.isna()).all():
+                out[c] = s32
+    out.attrs = dict(df.attrs)
+    after = out.memory_usage(index=False, deep=True)
+    report = pd.DataFrame({"Antes (MB)": before / 1024**2, "Depois (MB)": after.reindex(before.index).fillna(0) / 1024**2})
+    report.loc["Total"] = report.sum()
+    return out, report
+
+# ---------------- Exportação ----------------
+# Gravação em blocos: Ano/Mes e o PedidoItemKey em texto são recriados bloco
+# a bloco (modo compacto) e nenhum formato exige materializar o arquivo
+# inteiro em memória.
+EXPORT_CHUNK = 100_000
+XLSX_MAX_ROWS = 1_048_575  # limite de linhas do Excel, menos o cabeçalho
+def iter_chunks(df, size=EXPORT_CHUNK):
+    if len(df) == 0:
+        yield with_lazy_cols(df)
+    for i in range(0, len(df), size):
+        yield with_lazy_cols(df.iloc[i:i+size])
+
+# tipos Arrow de colunas object, pelo conteúdo da coluna inteira (um frame
+# vazio daria tipo null e a conversão dos blocos falharia)
+ARROW_OBJECT_TYPES = {"string": "string", "empty": "string", "integer": "int64", "floating": "float64",
+                      "mixed-integer-float": "float64", "boolean": "bool", "date": "date32", "bytes": "binary"}
+
+def _export_schema(safe):
+    schema = pa.Schema.from_pandas(with_lazy_cols(safe.head(0)), preserve_index=False)
+    for i, field in enumerate(schema):
+        if field.name in safe.columns and safe[field.name].dtype == object:
+            s = safe[field.name]
+            kind = ARROW_OBJECT_TYPES.get(pd.api.types.infer_dtype(s, skipna=True))
+            typ = pa.type_for_alias(kind) if kind else pa.array(s.dropna().head(1000)).type
+            schema = schema.set(i, pa.field(field.name, typ))
+        elif field.name == "PedidoItemKey" and pa.types.is_null(field.type):
+            schema = schema.set(i, pa.field(field.name, pa.string()))
+    return schema
+
+def write_export(df, fmt, path):
+    if fmt in ("csv", "csv.gz"):
+        opener = gzip.open if fmt == "csv.gz" else open
+        with opener(path, "wt", encoding="utf-8-sig", newline="") as f:
+            for i, chunk in enumerate(iter_chunks(df)):
+                chunk.to_csv(f, index=False, header=(i == 0))
+    elif fmt == "parquet":
+        safe, _ = _arrow_safe(df)
+        schema = _export_schema(safe)
+        if "Ano" not in safe.columns and "Data / Mês" in safe.columns and safe["Data / Mês"].isna().any():
+            # com datas vazias Ano/Mes saem como float em alguns blocos
+            for c in LAZY_COLS:
+                schema = schema.set(schema.get_field_index(c), pa.field(c, pa.float64()))
+        with pq.ParquetWriter(path, schema) as w:
+            for chunk in iter_chunks(safe):
+                w.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    elif fmt == "xlsx":
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.styles import Font
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Filtrado")
+        cols = with_lazy_cols(df.head(0)).columns
+        header = []
+        for c in cols:
+            cell = WriteOnlyCell(ws, value=str(c))
+            cell.font = Font(bold=True)
+            header.append(cell)
+        ws.append(header)
+        num_fmt = {}
+        for i, c in enumerate(cols):
+            if c in MONEY_COLS:
+                num_fmt[i] = "#,##0.00"
+            elif c in PCT_COLS:
+                num_fmt[i] = '0.0"%"'
+            elif c in df.columns and pd.api.types.is_datetime64_any_dtype(df[c]):
+                num_fmt[i] = "dd/mm/yyyy"
+        for chunk in iter_chunks(df.iloc[:XLSX_MAX_ROWS]):
+            for row in chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None):
+                out = list(row)
+                for i, f in num_fmt.items():
+                    cell = WriteOnlyCell(ws, value=out[i])
+                    cell.number_format = f
+                    out[i] = cell
+                ws.append(out)
+        wb.save(path)
+    else:
+        raise ValueError(f"Formato de exportação desconhecido: {fmt}")
+
+# ---------------- Filtros, KPIs, RFM e ABC ----------------
+def apply_filters(engine, **filters):
+    return engine.filter(**filters)
+
+def calc_kpis(_df):
+    fat = _df["Valor Pedido R$"].sum() if "Valor Pedido R$" in _df.columns else np.nan
+    n_ped = _df["Pedido"].nunique() if "Pedido" in _df.columns else len(_df)
+    n_cli = _df["Nome Cliente"].nunique() if "Nome Cliente" in _df.columns else np.nan
+    n_sku = _df["ITEM"].nunique() if "ITEM" in _df.columns else np.nan
+    ticket = (fat / n_ped) if (n_ped and n_ped>0) else np.nan
+    lucro = _df["Lucro Bruto"].sum() if "Lucro Bruto" in _df.columns else np.nan
+    margem_w = 100*(lucro/fat) if (pd.notna(lucro) and fat and fat>0) else np.nan
+    pct_rentavel = 100.0*(_df["Lucro Bruto"]>0).mean() if "Lucro Bruto" in _df.columns and len(_df)>0 else np.nan
+    return fat, n_ped, n_cli, n_sku, ticket, lucro, margem_w, pct_rentavel
+
+# Faixas por escala de score: (alto, médio, baixo). Em tercis reproduz as
+# regras originais (3 / 2 / 1); em quintis o topo são as faixas 4–5.
+RFM_TIERS = {3: (3, 2, 1), 5: (4, 3, 2)}
+
+def rfm_score(s, tiers=3):
+    try:
+        return pd.qcut(s.rank(method="first"), q=tiers, labels=False).astype(int) + 1
+    except Exception:
+        return pd.Series(tiers//2 + 1, index=s.index)
+
+def compute_rfm(_df, ref_date=None, tiers=3):
+    base = _df.dropna(subset=["Nome Cliente"]) if "Nome Cliente" in _df.columns else _df
+    if ref_date is None:
+        if "Data do Pedido" in base.columns and base["Data do Pedido"].notna().any():
+            ref_date = pd.to_datetime(base["Data do Pedido"]).max()
+        elif "Data / Mês" in base.columns and base["Data / Mês"].notna().any():
+            ref_date = pd.to_datetime(base["Data / Mês"]).max()
+        else:
+            ref_date = pd.Timestamp.today().normalize()
+
+    # uma única agregação por cliente
+    date_col = "Data do Pedido" if "Data do Pedido" in base.columns and base["Data do Pedido"].notna().any() else "Data / Mês"
+    aggs = {"UltimaCompra": (date_col, "max")}
+    aggs["Frequencia"] = ("Pedido", "nunique") if "Pedido" in base.columns else (date_col, "size")
+    if "Valor Pedido R$" in base.columns:
+        aggs["Valor"] = ("Valor Pedido R$", "sum")
+    rfm = base.groupby("Nome Cliente", observed=True).agg(**aggs)
+    rfm["RecenciaDias"] = (pd.to_datetime(ref_date) - pd.to_datetime(rfm["UltimaCompra"])).dt.days
+
+    rfm["R_Score"] = rfm_score(-rfm["RecenciaDias"].fillna(rfm["RecenciaDias"].max()), tiers)
+    rfm["F_Score"] = rfm_score(rfm["Frequencia"].fillna(0), tiers)
+    rfm["M_Score"] = rfm_score(rfm["Valor"].fillna(0), tiers)
+    rfm["Score"] = rfm["R_Score"] + rfm["F_Score"] + rfm["M_Score"]
+
+    hi, mid, lo = RFM_TIERS[tiers]
+    r, f, m = rfm["R_Score"].to_numpy(), rfm["F_Score"].to_numpy(), rfm["M_Score"].to_numpy()
+    rfm["Segmento"] = np.select(
+        [(r>=hi) & (f>=hi) & (m>=hi), (f>=hi) & (r>=mid), (r<=lo) & (m>=mid), (r<=lo) & (f<=lo)],
+        ["Campeões", "Leais", "Em risco", "Perdidos"],
+        default="Oportunidades",
+    )
+    rfm = rfm.sort_values(["Score","Valor","Frequencia"], ascending=[False,False,False]).reset_index()
+    rfm.rename(columns={"index":"Nome Cliente"}, inplace=True)
+    return rfm
+
+# ---------------- Classes ABC/XYZ ----------------
+# ABC pela participação acumulada (cumsum + searchsorted nos cortes) para
+# qualquer dimensão e medida; XYZ pelo coeficiente de variação do faturamento
+# mensal de cada membro, com meses sem venda valendo zero. Tudo em arrays
+# por código do membro, sem groupby por linha nem apply.
+ABC_DIMS = ["Nome Cliente","ITEM","Representante","UF"]
+ABC_MEASURES = ["Valor Pedido R$","Lucro Bruto"]
+ABC_CUTS = (80.0, 95.0)  # % acumulado: A até 80, B até 95, C o resto
+XYZ_CUTS = (0.5, 1.0)    # coef. de variação mensal: X até 0,5, Y até 1,0, Z acima
+ABC_LABELS = np.array(["A","B","C"])
+XYZ_LABELS = np.array(["X","Y","Z"])
+
+def abc_classes(values, cuts=ABC_CUTS):
+    """Recebe o total de cada membro e devolve, na ordem decrescente:
+    (ordem, %Part, %Acum, código da classe 0-2). Membros com total <= 0 não
+    somam participação acumulada e caem em C."""
+    v = np.nan_to_num(np.asarray(values, dtype=float))
+    order = np.argsort(-v, kind="stable")
+    v = v[order]
+    total = np.clip(v, 0, None).sum()
+    if total <= 0:
+        return order, np.full(len(v), np.nan), np.full(len(v), np.nan), np.full(len(v), 2)
+    acum = 100.0 * np.cumsum(np.clip(v, 0, None)) / total
+    cls = np.searchsorted(np.asarray(cuts), acum, side="left")
+    cls[v <= 0] = 2
+    return order, 100.0 * v / total, acum, np.minimum(cls, 2)
+
+def monthly_cv(codes, dates, values, n, d_ini=None, d_fim=None):
+    """Coeficiente de variação (desvio/média) da soma mensal de `values` de
+    cada um dos `n` membros entre d_ini e d_fim (ou o intervalo dos dados).
+    Com muitos membros só as células membro × mês com venda são materializadas."""
+    months, valid = period_codes(dates, "M")
+    codes, months, values = codes[valid], months[valid], values[valid]
+    if not len(months):
+        return np.full(n, np.nan)
+    if d_ini is not None:
+        (lo, hi), _ = period_codes([d_ini, d_fim], "M")
+    else:
+        lo, hi = months.min(), months.max()
+    n_months = int(hi - lo) + 1
+    flat = codes.astype(np.int64) * n_months + (months - lo)
+    if n * n_months <= 4 * len(flat):  # grade densa pequena: sem ordenar
+        cells = np.arange(n * n_months)
+        sums = np.bincount(flat, weights=values, minlength=len(cells))
+    else:
+        cells, inv = np.unique(flat, return_inverse=True)
+        sums = np.bincount(inv, weights=values, minlength=len(cells))
+    member = cells // n_months
+    mean = np.bincount(member, weights=sums, minlength=n) / n_months
+    var = np.maximum(np.bincount(member, weights=sums * sums, minlength=n) / n_months - mean * mean, 0)
+    return np.where(mean > 0, np.sqrt(var) / np.where(mean > 0, mean, 1), np.nan)
+
+def classify(df, dim, measure="Valor Pedido R$", d_ini=None, d_fim=None, cuts=ABC_CUTS, xyz_cuts=XYZ_CUTS):
+    """Uma linha por membro de `dim`, do maior para o menor em `measure`:
+    total, %Part, %Acum, ABC, CV mensal do faturamento, XYZ e Classe (ex.: AX)."""
+    cols = [dim, measure, "%Part", "%Acum", "ABC", "CV", "XYZ", "Classe"]
+    if dim not in df.columns or measure not in df.columns or not len(df):
+        return pd.DataFrame(columns=cols)
+    codes, members = pd.factorize(df[dim])
+    ok = codes >= 0
+    codes = codes[ok]
+    n = len(members)
+    values = np.nan_to_num(df[measure].to_numpy(dtype=float)[ok])
+    totals = np.bincount(codes, weights=values, minlength=n)
+    order, part, acum, abc = abc_classes(totals, cuts)
+    if "Data / Mês" in df.columns:
+        fat = values if measure == "Valor Pedido R$" or "Valor Pedido R$" not in df.columns \
+            else np.nan_to_num(df["Valor Pedido R$"].to_numpy(dtype=float)[ok])
+        cv = monthly_cv(codes, df["Data / Mês"].to_numpy()[ok], fat, n, d_ini, d_fim)[order]
+    else:
+        cv = np.full(n, np.nan)
+    xyz = np.where(np.isnan(cv), 2, np.searchsorted(np.asarray(xyz_cuts), cv, side="left"))
+    abc_l, xyz_l = ABC_LABELS[abc], XYZ_LABELS[np.minimum(xyz, 2)]
+    return pd.DataFrame({dim: np.asarray(members)[order],
+                         measure: totals[order],
+                         "%Part": part, "%Acum": acum, "ABC": abc_l, "CV": cv, "XYZ": xyz_l,
+                         "Classe": np.char.add(abc_l, xyz_l)})
+
+def _class_grid(row, col, weights=None):
+    # soma de weights (ou contagem) por par de códigos 0-2 numa grade 3×3
+    return np.bincount(row * 3 + col, weights=weights, minlength=9).reshape(3, 3)
+
+def abc_xyz_matrix(tbl, measure="Valor Pedido R$"):
+    """(membros, % da medida) por ABC nas linhas e XYZ nas colunas."""
+    if not len(tbl):
+        return None, None
+    a = np.searchsorted(ABC_LABELS, tbl["ABC"].to_numpy())
+    x = np.searchsorted(XYZ_LABELS, tbl["XYZ"].to_numpy())
+    count = pd.DataFrame(_class_grid(a, x).astype(np.int64), index=ABC_LABELS, columns=XYZ_LABELS)
+    val = _class_grid(a, x, np.clip(tbl[measure].to_numpy(dtype=float), 0, None))
+    share = pd.DataFrame(100.0 * val / val.sum() if val.sum() > 0 else np.full((3, 3), np.nan),
+                         index=ABC_LABELS, columns=XYZ_LABELS)
+    return count, share
+
+def _member_class(col, tbl):
+    # código ABC (0-2) de cada linha, via código do membro; -1 sem membro
+    codes, members = pd.factorize(col)
+    cls = np.searchsorted(ABC_LABELS, tbl["ABC"].to_numpy())
+    pos = pd.Index(tbl.iloc[:, 0]).get_indexer(members)
+    by_member = np.where(pos >= 0, cls[np.maximum(pos, 0)], -1)
+    return np.where(codes >= 0, by_member[codes], -1)
+
+def cross_classes(df, cli_tbl, sku_tbl, measure="Valor Pedido R$"):
+    """Soma de `measure` por classe ABC do cliente (linhas) × classe ABC do
+    SKU (colunas): quanto do faturamento dos clientes A vem de SKUs C etc."""
+    if not len(cli_tbl) or not len(sku_tbl) or measure not in df.columns:
+        return None
+    r, c = _member_class(df["Nome Cliente"], cli_tbl), _member_class(df["ITEM"], sku_tbl)
+    ok = (r >= 0) & (c >= 0)
+    grid = _class_grid(r[ok], c[ok], np.nan_to_num(df[measure].to_numpy(dtype=float)[ok]))
+    return pd.DataFrame(grid, index=[f"Clientes {k}" for k in ABC_LABELS], columns=[f"SKUs {k}" for k in ABC_LABELS])
+
+# ---------------- Dados de gráficos ----------------
+# O navegador recebe no máximo CHART_MAX_POINTS pontos por gráfico de
+# dispersão; acima disso os pontos viram um histograma 2D e só os mais
+# afastados do centro seguem individualmente.
+CHART_MAX_POINTS = 2000
+CHART_OUTLIERS = 200
+CHART_BINS = (40, 30)
+
+def _robust_z(v):
+    med = np.median(v)
+    scale = np.subtract(*np.percentile(v, [75, 25])) or np.abs(v - med).max() or 1.0
+    return (v - med) / scale
+
+def scatter_reduce(df, x, y, max_points=CHART_MAX_POINTS, outliers=CHART_OUTLIERS, bins=CHART_BINS):
+    """Retorna (pontos, grade). grade é None quando df cabe em max_points;
+    senão tem as bordas <x>_ini/<x>_fim, <y>_ini/<y>_fim e Qtde por célula."""
+    if len(df) <= max_points:
+        return df, None
+    d = df[np.isfinite(df[x].to_numpy(dtype=float)) & np.isfinite(df[y].to_numpy(dtype=float))]
+    xv, yv = d[x].to_numpy(dtype=float), d[y].to_numpy(dtype=float)
+    keep = np.zeros(len(d), dtype=bool)
+    n_out = min(outliers, len(d))
+    if n_out:
+        keep[np.argpartition(-np.hypot(_robust_z(xv), _robust_z(yv)), n_out - 1)[:n_out]] = True
+    counts, xe, ye = np.histogram2d(xv[~keep], yv[~keep], bins=bins)
+    ix, iy = np.nonzero(counts)
+    grid = pd.DataFrame({f"{x}_ini": xe[ix], f"{x}_fim": xe[ix + 1], f"{y}_ini": ye[iy], f"{y}_fim": ye[iy + 1],
+                         "Qtde": counts[ix, iy].astype(np.int64)})
+    return d[keep], grid
+
+# ---------------- Perfil de execução ----------------
+# Tempo de parede, linhas e variação de memória (RSS) de cada etapa de uma
+# execução. Ao fechar, cada etapa e o resumo saem como linhas JSON no logger
+# "brasforma.perf" (quem usa decide o handler).
+PERF_LOG = logging.getLogger("brasforma.perf")
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):  # fora do Linux não há medida barata
+        return None
+
+class RunProfile:
+    def __init__(self, kind="completa", session=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.session = session
+        self.started = time.time()
+        self.stages = []
+        self.total_ms = None
+        self.closed = False
+        self._t0 = time.perf_counter()
+        self._stack = []
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        rec = {"etapa": name, "pai": self._stack[-1] if self._stack else None, "nivel": len(self._stack),
+               "inicio_ms": round(1000 * (time.perf_counter() - self._t0), 1), "linhas_in": rows_in, "linhas_out": None}
+        self._stack.append(name)
+        m0, t0 = rss_bytes(), time.perf_counter()
+        try:
+            yield rec
+        finally:
+            rec["ms"] = round(1000 * (time.perf_counter() - t0), 2)
+            m1 = rss_bytes()
+            rec["mem_delta_mb"] = round((m1 - m0) / 1024**2, 2) if m0 is not None and m1 is not None else None
+            self._stack.pop()
+            self.stages.append(rec)
+
+    def frame(self):
+        cols = ["etapa","pai","nivel","inicio_ms","ms","linhas_in","linhas_out","mem_delta_mb"]
+        return pd.DataFrame(self.stages, columns=cols).sort_values("inicio_ms", kind="stable").reset_index(drop=True)
+
+    def summary(self):
+        top = [r for r in self.stages if r["nivel"] == 0]
+        slowest = max(top, key=lambda r: r["ms"]) if top else None
+        rss = rss_bytes()
+        return {"evento": "execucao", "run": self.id, "sessao": self.session, "tipo": self.kind,
+                "inicio": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)), "total_ms": self.total_ms,
+                "etapa_mais_lenta": slowest["etapa"] if slowest else None, "rss_mb": round(rss / 1024**2, 1) if rss else None}
+
+    def close(self):
+        if not self.closed:
+            self.total_ms = round(1000 * (time.perf_counter() - self._t0), 1)
+            self.closed = True
+            if PERF_LOG.isEnabledFor(logging.INFO):
+                base = {"run": self.id, "sessao": self.session, "tipo": self.kind}
+                for rec in sorted(self.stages, key=lambda r: r["inicio_ms"]):
+                    PERF_LOG.info(json.dumps({"evento": "etapa", **base, **rec}, ensure_ascii=False, default=str))
+                PERF_LOG.info(json.dumps(self.summary(), ensure_ascii=False, default=str))
+        return self
@@ -7,22 +7,24 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import altair as alt
+import functools
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
 from pathlib import Path
 
-st.set_page_config(page_title="Brasforma – Dashboard Comercial v6", layout="wide")
+from brasforma_core import (
+    ABC_CUTS, ABC_DIMS, CACHE_DIR, DATASETS, PERF_LOG, STORE_SESSION_TTL, XLSX_MAX_ROWS, XYZ_CUTS, XYZ_LABELS,
+    FilterEngine, RunProfile, WorkbookError, abc_xyz_matrix, apply_filters, cache_entries, cache_stats, calc_kpis,
+    compact_frame, compute_rfm, dataset_meta, frame_nbytes, load_data, load_many, merge_frames, merge_meta,
+    period_kpis, pq, prepare_many, prepared_meta, read_prepared, scatter_reduce, series_window, shift_period,
+    snapshot_diff, snapshot_history, trim_categories, with_lazy_cols, workbook_key, write_export,
+)
 
 # ---------------- Utils ----------------
-def to_num(x):
-    if pd.isna(x):
-        return np.nan
-    if isinstance(x, (int, float, np.integer, np.floating)):
-        return float(x)
-    s = str(x).strip().replace(".", "").replace(",", ".")
-    try:
-        return float(s)
-    except Exception:
-        return np.nan
-
 def fmt_money(v):
     if pd.isna(v): return "-"
     return ("R$ " + f"{v:,.2f}").replace(",", "X").replace(".", ",").replace("X", ".")
@@ -35,219 +37,352 @@ def fmt_pct(v, decimals=1):
     if pd.isna(v): return "-"
     return f"{v:.{decimals}f}%".replace(".", ",")
 
-def display_table(df, money_cols=None, pct_cols=None, int_cols=None, max_rows=500):
+def fmt_delta(v, unit="%"):
+    if v is None or pd.isna(v): return None
+    return f"{v:+.1f}".replace(".", ",") + unit
+
+# ---------------- Perfil de execução ----------------
+# Cada execução do script (ou de um fragmento sozinho) vira um RunProfile;
+# as etapas vão para o log em JSON e as mais lentas ficam na sessão.
+if not PERF_LOG.handlers and os.environ.get("BRASFORMA_PERF_LOG", "1") != "0":
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    PERF_LOG.addHandler(_handler)
+    PERF_LOG.setLevel(logging.INFO)
+    PERF_LOG.propagate = False
+PERF_KEEP = 10  # execuções mais lentas guardadas por sessão
+
+SESSION = st.session_state.setdefault("session_id", uuid.uuid4().hex[:8])
+PROF = RunProfile("completa", session=SESSION)
+
+def finish_profile(prof):
+    prof.close()
+    hist = st.session_state.setdefault("perf_hist", [])
+    hist.append({**prof.summary(), "etapas": prof.frame()})
+    hist.sort(key=lambda r: -r["total_ms"])
+    del hist[PERF_KEEP:]
+
+def profiled_fragment(fn):
+    # Numa execução completa a aba entra no perfil corrente; quando só o
+    # fragmento reexecuta, o perfil da última execução já está fechado.
+    @st.fragment
+    @functools.wraps(fn)
+    def run():
+        global PROF
+        own = PROF.closed
+        if own:
+            PROF = RunProfile("fragmento", session=PROF.session)
+        with PROF.stage("aba:" + fn.__name__.removeprefix("render_"), rows_in=len(flt)):
+            fn()
+        if own:
+            finish_profile(PROF)
+    return run
+
+def show_chart(chart, **kwargs):
+    layers = [ch for ch in getattr(chart, "layer", None) or [chart] if isinstance(ch.data, pd.DataFrame)]
+    for ch in layers:
+        ch.data = trim_categories(ch.data)
+    with PROF.stage("grafico", rows_in=sum(len(ch.data) for ch in layers)):
+        st.altair_chart(chart, **kwargs)
+
+def scatter_chart(data, x, y, x_title, y_title, tooltip, color=None, height=420):
+    # até CHART_MAX_POINTS pontos; acima disso, histograma 2D + pontos extremos
+    pts, grid = scatter_reduce(data, x, y)
+    enc = dict(x=alt.X(f"{x}:Q", title=x_title), y=alt.Y(f"{y}:Q", title=y_title), tooltip=tooltip)
+    if color is not None:
+        enc["color"] = color
+    points = alt.Chart(pts.reset_index(drop=True)).mark_circle(size=70).encode(**enc)
+    if grid is None:
+        return points.properties(height=height)
+    cells = alt.Chart(grid).mark_rect(opacity=0.85).encode(
+        x=alt.X(f"{x}_ini:Q", title=x_title), x2=alt.X2(f"{x}_fim"),
+        y=alt.Y(f"{y}_ini:Q", title=y_title), y2=alt.Y2(f"{y}_fim"),
+        color=alt.Color("Qtde:Q", scale=alt.Scale(scheme="greys"), title="Clientes por célula"),
+        tooltip=[alt.Tooltip("Qtde:Q", title="Clientes")],
+    )
+    return alt.layer(cells, points).resolve_scale(color="independent").properties(height=height)
+
+# Formatos pt-BR aplicados pelo Styler: o grid recebe os valores numéricos
+# (ordenação correta) e só as células enviadas são formatadas.
+TABLE_FORMATS = {"money": "R$ {:,.2f}", "pct": "{:.1f}%", "int": "{:,.0f}"}
+
+def style_table(view, money_cols=(), pct_cols=(), int_cols=()):
+    sty = view.style
+    for kind, cols in [("money", money_cols), ("pct", pct_cols), ("int", int_cols)]:
+        cols = [c for c in cols if c in view.columns]
+        if cols:
+            sty = sty.format(TABLE_FORMATS[kind], subset=cols, na_rep="-", thousands=".", decimal=",")
+    return sty
+
+def display_table(df, money_cols=None, pct_cols=None, int_cols=None, max_rows=500, page_size=None, key=None):
+    """Tabela formatada; com page_size, ordenação e paginação ficam no servidor
+    e só a página visível é enviada ao navegador (requer key única)."""
     money_cols = money_cols or []
     pct_cols = pct_cols or []
     int_cols = int_cols or []
-    view = df.copy().head(max_rows)
-    for c in view.columns:
-        if c in money_cols:
-            view[c] = view[c].apply(fmt_money)
-        elif c in pct_cols:
-            view[c] = view[c].apply(lambda x: fmt_pct(x, 1))
-        elif c in int_cols:
-            view[c] = view[c].apply(fmt_int)
-    st.dataframe(view, use_container_width=True)
-
-# ---------------- Load & prep ----------------
-@st.cache_data(show_spinner=False)
-def load_data(path: str, sheet_name="Carteira de Vendas"):
-    try:
-        xls = pd.ExcelFile(path, engine="openpyxl")
-    except Exception as e:
-        st.error("Falha ao abrir Excel. Verifique .xlsx e dependência openpyxl.")
-        st.exception(e)
-        st.stop()
-    df = pd.read_excel(xls, sheet_name=sheet_name)
-    df.columns = [c.strip() for c in df.columns]
-
-    for col in ["Data / Mês","Data Final","Data do Pedido","Data da Entrega","Data Inserção"]:
-        if col in df.columns:
-            df[col] = pd.to_datetime(df[col], errors="coerce")
-
-    for col in ["Valor Pedido R$","TICKET MÉDIO","Quant. Pedidos","Custo"]:
-        if col in df.columns:
-            if col == "Quant. Pedidos":
-                df[col] = pd.to_numeric(df[col], errors="coerce")
-            else:
-                df[col] = df[col].apply(to_num)
-
-    if "Data / Mês" in df.columns:
-        df["Ano"] = df["Data / Mês"].dt.year
-        df["Mes"] = df["Data / Mês"].dt.month
-        df["Ano-Mes"] = df["Data / Mês"].dt.to_period("M").astype(str)
-
-    if "Data do Pedido" in df.columns and "Data da Entrega" in df.columns:
-        df["LeadTime (dias)"] = (df["Data da Entrega"] - df["Data do Pedido"]).dt.days
-
-    if "Atrasado / No prazo" in df.columns:
-        df["AtrasadoFlag"] = df["Atrasado / No prazo"].astype(str).str.contains("Atras", case=False, na=False)
-
-    # COST: unitário x quantidade (auto-detect; fallback para coluna M)
-    qty_candidates = ["Qtde","QTDE","Quantidade","Quantidade Pedido","Qtd","QTD","Quant.","Quant","Qde","QTD.","QTD PEDIDA","QTD PEDIDO","QTD SOLICITADA","QTD Solicitada"]
-    qty_col = None
-    for c in qty_candidates:
-        if c in df.columns:
-            qty_col = c; break
-    if qty_col is None:
-        try:
-            qty_col = df.columns[12]  # fallback para coluna M
-        except Exception:
-            qty_col = None
-
-    if "Custo" in df.columns:
-        if qty_col is not None:
-            df[qty_col] = df[qty_col].apply(to_num)
-            df["Custo Total"] = df["Custo"].apply(to_num) * df[qty_col]
+    with PROF.stage("tabela", rows_in=len(df)) as rec:
+        if page_size and len(df) > page_size:
+            c1, c2, c3 = st.columns([3, 1, 1])
+            by = c1.selectbox("Ordenar por", ["—"] + list(df.columns), key=f"{key}_ordem")
+            desc = c2.toggle("Decrescente", value=True, key=f"{key}_desc")
+            n_pages = -(-len(df) // page_size)
+            page = int(c3.number_input("Página", min_value=1, max_value=n_pages, value=1, step=1, key=f"{key}_pagina"))
+            if by != "—":
+                df = df.sort_values(by, ascending=not desc, kind="stable", na_position="last")
+            view = df.iloc[(page-1)*page_size : page*page_size]
+            st.caption(f"{fmt_int(len(df))} linhas · página {fmt_int(page)} de {fmt_int(n_pages)}")
         else:
-            df["Custo Total"] = df["Custo"].apply(to_num)
+            view = df.head(max_rows)
+        rec["linhas_out"] = len(view)
+        st.dataframe(style_table(trim_categories(view), money_cols, pct_cols, int_cols), use_container_width=True)
+
+# A base e o motor de filtros ficam uma única vez no DATASETS do processo e
+# são compartilhados, sem cópia, por todas as sessões. Com copy-on-write uma
+# escrita acidental num frame derivado copia antes de alterar a base comum.
+pd.set_option("mode.copy_on_write", True)
+
+def build_engine(keys, sources, compact):
+    if pq is not None:
+        df, meta = (read_prepared(keys[0]) if len(keys) == 1 else load_many(keys)), None
     else:
-        df["Custo Total"] = np.nan
-
-    if "Valor Pedido R$" in df.columns:
-        df["Lucro Bruto"] = df["Valor Pedido R$"] - df["Custo Total"]
-        df["Margem %"] = np.where(df["Valor Pedido R$"]>0, 100*df["Lucro Bruto"]/df["Valor Pedido R$"], np.nan)
-
-    if "Pedido" in df.columns and "ITEM" in df.columns:
-        df["PedidoItemKey"] = df["Pedido"].astype(str) + "||" + df["ITEM"].astype(str)
-
-    return df, qty_col
+        loaded = [load_data(s) for s in sources]
+        df = merge_frames([f for f, _ in loaded])
+        meta = dataset_meta(df, next((q for _, q in loaded if q), None))
+    report = None
+    if compact:
+        df, report = compact_frame(df)
+    # a medida profunda da base (segundos em bases grandes) fica na carga, fora do DATASETS
+    eng = FilterEngine(df, df_bytes=frame_nbytes(df))
+    eng.memory_report = report
+    eng.meta = meta
+    return eng
+
+def source_key(src):
+    # envios são lidos e hasheados uma vez; o file_id muda a cada novo envio
+    fid = getattr(src, "file_id", None)
+    if fid is None:
+        return workbook_key(src)
+    memo = st.session_state.setdefault("upload_keys", {})
+    if fid not in memo:
+        memo[fid] = workbook_key(src)
+    return memo[fid]
 
 DEFAULT_DATA = "Dashboard - Comite Semanal - Brasforma IA (1).xlsx"
 ALT_DATA = "Dashboard - Comite Semanal - Brasforma (1).xlsx"
 
 st.sidebar.title("Fonte de dados")
-uploaded = st.sidebar.file_uploader("Envie a base (.xlsx)", type=["xlsx"], accept_multiple_files=False)
-data_path = uploaded if uploaded is not None else (DEFAULT_DATA if Path(DEFAULT_DATA).exists() else ALT_DATA)
-st.sidebar.caption(f"Arquivo em uso: **{data_path}**")
-
-df, qty_col = load_data(data_path)
+uploaded = st.sidebar.file_uploader("Envie a(s) base(s) (.xlsx)", type=["xlsx"], accept_multiple_files=True)
+pasta = st.sidebar.text_input("Ou pasta com planilhas (.xlsx)")
+if uploaded:
+    sources = list(uploaded)  # na ordem de envio: a última prevalece
+elif pasta and Path(pasta).is_dir():
+    files = [f for f in Path(pasta).glob("*.xlsx") if not f.name.startswith("~$")]
+    sources = [str(f) for f in sorted(files, key=lambda f: f.stat().st_mtime)]  # mais recente por último
+else:
+    sources = [DEFAULT_DATA if Path(DEFAULT_DATA).exists() else ALT_DATA]
+names = [getattr(s, "name", str(s)) for s in sources]
+if len(sources) == 1:
+    st.sidebar.caption(f"Arquivo em uso: **{names[0]}**")
+else:
+    st.sidebar.caption(f"{fmt_int(len(sources))} arquivos em uso: " + ", ".join(f"**{n}**" for n in names))
+compact = st.sidebar.toggle("Modo compacto de memória", value=True)
+
+incremental = st.sidebar.toggle("Ingestão incremental", value=True, help="Reaproveita as linhas inalteradas da última carga desta aba.")
+try:
+    with PROF.stage("load_data") as rec:
+        wb_keys = tuple(source_key(s) for s in sources)
+        if pq is not None and len(sources) == 1:
+            meta = prepared_meta(sources[0], wb_keys[0], incremental)
+        elif pq is not None:
+            with st.spinner(f"Preparando {len(sources)} planilhas..."):
+                _, metas = prepare_many(sources, keys=wb_keys)
+            meta = merge_meta(metas)
+    with PROF.stage("filter_engine") as rec:
+        engine = DATASETS.acquire(("+".join(wb_keys), compact), SESSION,
+                                  lambda: build_engine(wb_keys, sources, compact), size=FilterEngine.nbytes)
+        if pq is None:
+            meta = engine.meta
+        df = engine.df
+        rec["linhas_out"] = len(df)
+except WorkbookError as e:
+    st.error(str(e))
+    st.exception(e.__cause__ or e)
+    st.stop()
+wb_key = "+".join(wb_keys)
+qty_col = meta["qty_col"]
+if meta["parse_fail"]:
+    st.sidebar.warning("Células numéricas não convertidas: " + ", ".join(f"{c} ({fmt_int(n)})" for c, n in meta["parse_fail"].items()))
+
+with st.sidebar.expander("Cache em disco"):
+    if pq is None:
+        st.caption("Desativado (instale pyarrow).")
+    else:
+        stats, entries = cache_stats(), cache_entries()
+        st.caption(f"Hits: {fmt_int(stats['hit'])} · Misses: {fmt_int(stats['miss'])}")
+        st.caption(f"{fmt_int(len(entries))} base(s) · {sum(e['bytes'] for e in entries)/1024**2:,.1f} MB".replace(",", "X").replace(".", ",").replace("X", "."))
+        history = [s for s in snapshot_history(entries) if s["key"] != wb_key]
+        if meta.get("delta"):
+            d = meta["delta"]
+            st.caption(f"Carga incremental: +{fmt_int(d['inseridas'])} novas · {fmt_int(d['alteradas'])} alteradas · "
+                       f"−{fmt_int(d['removidas'])} removidas · {fmt_int(d['mantidas'])} reaproveitadas")
+        if len(wb_keys) == 1 and history and (CACHE_DIR / wb_key / "_rows.parquet").exists():
+            labels = {time.strftime("%d/%m/%Y %H:%M", time.localtime(s["created"])) + f" ({fmt_int(s['rows'])} linhas)": s["key"] for s in history}
+            pick_snap = st.selectbox("Comparar com carga", list(labels))
+            if pick_snap and (CACHE_DIR / labels[pick_snap] / "_rows.parquet").exists():
+                d = snapshot_diff(labels[pick_snap], wb_key)
+                st.caption(f"+{fmt_int(d['inseridas'])} novas · {fmt_int(d['alteradas'])} alteradas · −{fmt_int(d['removidas'])} removidas")
+        if st.button("Limpar cache"):
+            shutil.rmtree(CACHE_DIR, ignore_errors=True)
+            DATASETS.clear()
+            st.rerun()
+    in_mem = DATASETS.stats()
+    st.caption(f"Em memória: {fmt_int(len(in_mem))} base(s) · {sum(e['bytes'] for e in in_mem)/1024**2:,.1f} MB · "
+               f"{fmt_int(sum(e['sessoes'] for e in in_mem))} sessão(ões)".replace(",", "X").replace(".", ",").replace("X", "."))
 
 st.sidebar.title("Filtros")
-if "Data / Mês" in df.columns:
-    min_date = pd.to_datetime(df["Data / Mês"]).min()
-    max_date = pd.to_datetime(df["Data / Mês"]).max()
+if "min_date" in meta:
+    min_date = pd.to_datetime(meta["min_date"])
+    max_date = pd.to_datetime(meta["max_date"])
     d_ini, d_fim = st.sidebar.date_input("Período (Data / Mês)", value=(min_date, max_date))
 else:
     d_ini = d_fim = None
 
-reg = st.sidebar.multiselect("Regional", sorted(df["Regional"].dropna().unique()) if "Regional" in df.columns else [])
-rep = st.sidebar.multiselect("Representante", sorted(df["Representante"].dropna().unique()) if "Representante" in df.columns else [])
-uf  = st.sidebar.multiselect("UF", sorted(df["UF"].dropna().unique()) if "UF" in df.columns else [])
-stat = st.sidebar.multiselect("Status Prod./Fat.", sorted(df["Status de Produção / Faturamento"].dropna().unique()) if "Status de Produção / Faturamento" in df.columns else [])
+if engine.memory_report is not None:
+    with st.sidebar.expander("Memória por coluna"):
+        rep_mem = engine.memory_report
+        st.caption(f"Total: {rep_mem.loc['Total','Antes (MB)']:.1f} MB → {rep_mem.loc['Total','Depois (MB)']:.1f} MB".replace(".", ","))
+        st.dataframe(rep_mem.round(2), use_container_width=True)
+
+opts = meta["options"]
+reg = st.sidebar.multiselect("Regional", opts.get("Regional", []))
+rep = st.sidebar.multiselect("Representante", opts.get("Representante", []))
+uf  = st.sidebar.multiselect("UF", opts.get("UF", []))
+stat = st.sidebar.multiselect("Status Prod./Fat.", opts.get("Status de Produção / Faturamento", []))
 cliente = st.sidebar.text_input("Cliente (contém)")
+if cliente and "Nome Cliente" in df.columns:
+    sug = engine.text_index("Nome Cliente").suggest(cliente)
+    st.sidebar.caption("Sugestões: " + " · ".join(map(str, sug)) if sug else "Nenhum cliente encontrado.")
 item = st.sidebar.text_input("SKU/Item (contém)")
+if item and "ITEM" in df.columns:
+    sug = engine.text_index("ITEM").suggest(item)
+    st.sidebar.caption("Sugestões: " + " · ".join(map(str, sug)) if sug else "Nenhum SKU encontrado.")
 show_neg = st.sidebar.checkbox("Mostrar apenas linhas com margem negativa", value=False)
 
-def apply_filters(_df):
-    flt = _df.copy()
-    if "Data / Mês" in flt.columns and d_ini is not None:
-        flt = flt[(flt["Data / Mês"] >= pd.to_datetime(d_ini)) & (flt["Data / Mês"] <= pd.to_datetime(d_fim))]
-    if reg:
-        flt = flt[flt["Regional"].isin(reg)]
-    if rep:
-        flt = flt[flt["Representante"].isin(rep)]
-    if uf:
-        flt = flt[flt["UF"].isin(uf)]
-    if stat:
-        flt = flt[flt["Status de Produção / Faturamento"].isin(stat)]
-    if cliente:
-        flt = flt[flt["Nome Cliente"].astype(str).str.contains(cliente, case=False, na=False)]
-    if item:
-        flt = flt[flt["ITEM"].astype(str).str.contains(item, case=False, na=False)]
-    if show_neg and "Lucro Bruto" in flt.columns:
-        flt = flt[flt["Lucro Bruto"] < 0]
-    return flt
-
-flt = apply_filters(df)
-
-# --------------- KPIs base ---------------
-def calc_kpis(_df):
-    fat = _df["Valor Pedido R$"].sum() if "Valor Pedido R$" in _df.columns else np.nan
-    n_ped = _df["Pedido"].nunique() if "Pedido" in _df.columns else len(_df)
-    n_cli = _df["Nome Cliente"].nunique() if "Nome Cliente" in _df.columns else np.nan
-    n_sku = _df["ITEM"].nunique() if "ITEM" in _df.columns else np.nan
-    ticket = (fat / n_ped) if (n_ped and n_ped>0) else np.nan
-    lucro = _df["Lucro Bruto"].sum() if "Lucro Bruto" in _df.columns else np.nan
-    margem_w = 100*(lucro/fat) if (pd.notna(lucro) and fat and fat>0) else np.nan
-    pct_rentavel = 100.0*(_df["Lucro Bruto"]>0).mean() if "Lucro Bruto" in _df.columns and len(_df)>0 else np.nan
-    return fat, n_ped, n_cli, n_sku, ticket, lucro, margem_w, pct_rentavel
-
-fat, n_ped, n_cli, n_sku, ticket, lucro, margem_w, pct_rentavel = calc_kpis(flt)
+filters = dict(d_ini=d_ini, d_fim=d_fim, reg=tuple(reg), rep=tuple(rep), uf=tuple(uf), stat=tuple(stat),
+               cliente=cliente, item=item, show_neg=show_neg)
+with PROF.stage("apply_filters", rows_in=len(df)) as rec:
+    flt = apply_filters(engine, **filters)
+    rec["linhas_out"] = len(flt)
+
+# KPIs e rankings saem do cubo quando os filtros permitem
+with PROF.stage("cubo"):
+    cube = engine.cube
+    cube_cells = cube.cell_mask(**filters)
+
+def group_sum(dim, cols):
+    if cube_cells is not None:
+        return cube.group_sum(dim, cols, cube_cells)
+    return flt.groupby(dim, as_index=False, observed=True)[cols].sum()
+
+def row_counts():
+    # (linhas, rentáveis, negativas)
+    if cube_cells is not None:
+        tot = cube.totals(cube_cells)
+        return int(tot["Linhas"]), int(tot["Positivas"]), int(tot["Negativas"])
+    return len(flt), int((flt["Lucro Bruto"]>0).sum()), int((flt["Lucro Bruto"]<0).sum())
+
+with PROF.stage("calc_kpis", rows_in=len(flt)):
+    if cube_cells is not None:
+        fat, n_ped, n_cli, n_sku, ticket, lucro, margem_w, pct_rentavel = cube.kpis(cube_cells)
+    else:
+        fat, n_ped, n_cli, n_sku, ticket, lucro, margem_w, pct_rentavel = calc_kpis(flt)
+
+TS_GRAIN = {"Mês": ("M", "meses"), "Semana": ("W", "semanas"), "Trimestre": ("Q", "trimestres")}
 
 # =============== Layout ===============
-tabs = st.tabs([
-    "Visão Executiva","Clientes – RFM","Rentabilidade","Clientes","Produtos","Representantes","Geografia","Operacional","Pareto/ABC","Exportar"
-])
-tab_exec, tab_rfm, tab_profit, tab_cli, tab_sku, tab_rep, tab_geo, tab_ops, tab_pareto, tab_export = tabs
+# Cada aba é um fragmento: só a visão escolhida é calculada e um widget
+# dentro dela reexecuta apenas o próprio fragmento.
+VIEWS = ["Visão Executiva","Clientes – RFM","Rentabilidade","Clientes","Produtos","Representantes","Geografia","Operacional","Pareto/ABC","Exportar"]
+view = st.radio("Visão", VIEWS, horizontal=True, label_visibility="collapsed", key="view")
 
-with tab_exec:
+@profiled_fragment
+def render_exec():
     st.subheader("KPIs Executivos")
+    # variações contra o mesmo período do ano anterior, com os mesmos filtros
+    prev_filters = shift_period(filters)
+    d = dict.fromkeys(["fat","n_ped","ticket","lucro","margem","rentavel"])
+    if prev_filters is not None:
+        p_fat, p_ped, _, _, p_ticket, p_lucro, p_margem, p_rent = period_kpis(engine, **prev_filters)
+        pct = lambda cur, old: 100.0*(cur-old)/old if pd.notna(cur) and pd.notna(old) and old > 0 else None
+        pp = lambda cur, old: cur-old if pd.notna(cur) and pd.notna(old) else None
+        d.update(fat=pct(fat, p_fat), n_ped=pct(n_ped, p_ped), ticket=pct(ticket, p_ticket), lucro=pct(lucro, p_lucro),
+                 margem=pp(margem_w, p_margem), rentavel=pp(pct_rentavel, p_rent))
     c1, c2, c3 = st.columns(3)
-    c1.metric("Faturamento", fmt_money(fat))
-    c2.metric("Pedidos", fmt_int(n_ped))
-    c3.metric("Ticket Médio", fmt_money(ticket) if pd.notna(ticket) else "-")
+    c1.metric("Faturamento", fmt_money(fat), delta=fmt_delta(d["fat"]))
+    c2.metric("Pedidos", fmt_int(n_ped), delta=fmt_delta(d["n_ped"]))
+    c3.metric("Ticket Médio", fmt_money(ticket) if pd.notna(ticket) else "-", delta=fmt_delta(d["ticket"]))
     c4, c5, c6 = st.columns(3)
-    c4.metric("Lucro Bruto", fmt_money(lucro))
-    c5.metric("Margem Bruta (pond.)", fmt_pct(margem_w) if pd.notna(margem_w) else "-")
-    c6.metric("% Itens Rentáveis", fmt_pct(pct_rentavel) if pd.notna(pct_rentavel) else "-")
+    c4.metric("Lucro Bruto", fmt_money(lucro), delta=fmt_delta(d["lucro"]))
+    c5.metric("Margem Bruta (pond.)", fmt_pct(margem_w) if pd.notna(margem_w) else "-", delta=fmt_delta(d["margem"], " p.p."))
+    c6.metric("% Itens Rentáveis", fmt_pct(pct_rentavel) if pd.notna(pct_rentavel) else "-", delta=fmt_delta(d["rentavel"], " p.p."))
+    if prev_filters is not None:
+        st.caption(f"Variações sobre o mesmo período do ano anterior "
+                   f"({prev_filters['d_ini']:%d/%m/%Y} a {prev_filters['d_fim']:%d/%m/%Y}).")
 
     st.markdown("### KPI gráficos")
-    # Séries mensais (últimos 12)
-    if {"Ano-Mes","Valor Pedido R$","Lucro Bruto"} .issubset(flt.columns):
-        serie = flt.groupby("Ano-Mes", as_index=False).agg({
-            "Valor Pedido R$":"sum",
-            "Lucro Bruto":"sum"
-        }).sort_values("Ano-Mes")
-        # Margem mensal (ponderada)
-        mg = flt.groupby("Ano-Mes", as_index=False).apply(lambda d: pd.Series({
-            "Margem %": (100*d["Lucro Bruto"].sum()/d["Valor Pedido R$"].sum()) if d["Valor Pedido R$"].sum()>0 else np.nan
-        })).reset_index(drop=True)
-        serie = serie.merge(mg, on="Ano-Mes", how="left")
-        if len(serie)>12:
-            serie = serie.tail(12)
+    # Séries (últimos 12 períodos): somas cacheadas por estado de filtro no motor
+    if {"Data / Mês","Valor Pedido R$","Lucro Bruto"} .issubset(flt.columns):
+        gran = st.radio("Granularidade", list(TS_GRAIN), horizontal=True, key="exec_gran")
+        freq, unit = TS_GRAIN[gran]
+        serie = series_window(engine, freq, 12, **filters)
+        last = serie.iloc[-1] if len(serie) else None
+        if last is not None and freq == "M":
+            st.caption(f"3 meses: {fmt_money(last['Valor 3M'])} (margem {fmt_pct(last['Margem 3M %'])}) · "
+                       f"12 meses: {fmt_money(last['Valor 12M'])} (margem {fmt_pct(last['Margem 12M %'])}) · "
+                       f"MoM {fmt_delta(last['Var. %']) or '-'} · YoY {fmt_delta(last['YoY %']) or '-'}")
+        elif last is not None:
+            st.caption(f"{last['Periodo']}: var. {fmt_delta(last['Var. %']) or '-'} · YoY {fmt_delta(last['YoY %']) or '-'}")
 
         k1, k2, k3 = st.columns(3)
         with k1:
-            st.caption("Faturamento – últimos 12 meses")
-            st.altair_chart(
-                alt.Chart(serie).mark_area(opacity=0.4).encode(
-                    x=alt.X("Ano-Mes:N", sort=None, title=None),
+            st.caption(f"Faturamento – últimos 12 {unit}")
+            show_chart(
+                alt.Chart(serie[["Periodo","Valor Pedido R$"]]).mark_area(opacity=0.4).encode(
+                    x=alt.X("Periodo:N", sort=None, title=None),
                     y=alt.Y("Valor Pedido R$:Q", title=None),
-                    tooltip=[alt.Tooltip("Ano-Mes:N"), alt.Tooltip("Valor Pedido R$:Q", format=",.0f")]
+                    tooltip=[alt.Tooltip("Periodo:N", title="Período"), alt.Tooltip("Valor Pedido R$:Q", format=",.0f")]
                 ),
                 use_container_width=True
             )
         with k2:
-            st.caption("Lucro Bruto – últimos 12 meses")
-            st.altair_chart(
-                alt.Chart(serie).mark_area(opacity=0.4).encode(
-                    x=alt.X("Ano-Mes:N", sort=None, title=None),
+            st.caption(f"Lucro Bruto – últimos 12 {unit}")
+            show_chart(
+                alt.Chart(serie[["Periodo","Lucro Bruto"]]).mark_area(opacity=0.4).encode(
+                    x=alt.X("Periodo:N", sort=None, title=None),
                     y=alt.Y("Lucro Bruto:Q", title=None),
-                    tooltip=[alt.Tooltip("Ano-Mes:N"), alt.Tooltip("Lucro Bruto:Q", format=",.0f")]
+                    tooltip=[alt.Tooltip("Periodo:N", title="Período"), alt.Tooltip("Lucro Bruto:Q", format=",.0f")]
                 ),
                 use_container_width=True
             )
         with k3:
-            st.caption("Margem Bruta (%) – últimos 12 meses")
-            st.altair_chart(
-                alt.Chart(serie).mark_line(point=True).encode(
-                    x=alt.X("Ano-Mes:N", sort=None, title=None),
+            st.caption(f"Margem Bruta (%) – últimos 12 {unit}")
+            show_chart(
+                alt.Chart(serie[["Periodo","Margem %"]]).mark_line(point=True).encode(
+                    x=alt.X("Periodo:N", sort=None, title=None),
                     y=alt.Y("Margem %:Q", title=None),
-                    tooltip=[alt.Tooltip("Ano-Mes:N"), alt.Tooltip("Margem %:Q", format=",.1f")]
+                    tooltip=[alt.Tooltip("Periodo:N", title="Período"), alt.Tooltip("Margem %:Q", format=",.1f")]
                 ),
                 use_container_width=True
             )
 
     # Donut 100%: Itens rentáveis vs negativos
     if "Lucro Bruto" in flt.columns and len(flt)>0:
-        pos = int((flt["Lucro Bruto"]>0).sum())
-        neg = int((flt["Lucro Bruto"]<0).sum())
+        _, pos, neg = row_counts()
         donut_df = pd.DataFrame({"Categoria": ["Rentáveis","Negativos"], "Qtd": [pos, neg]})
         cdon1, cdon2 = st.columns([2,1])
         with cdon1:
             st.caption("Composição de linhas – rentáveis vs negativas")
-            st.altair_chart(
+            show_chart(
                 alt.Chart(donut_df).mark_arc(innerRadius=60).encode(
                     theta="Qtd:Q",
                     color="Categoria:N",
@@ -260,54 +395,19 @@ with tab_exec:
             st.metric("% Linhas Rentáveis", fmt_pct(100*pos/tot) if tot>0 else "-")
 
 # ---------------- RFM ----------------
-def compute_rfm(_df, ref_date=None):
-    base = _df.dropna(subset=["Nome Cliente"]) if "Nome Cliente" in _df.columns else _df.copy()
-    if ref_date is None:
-        if "Data do Pedido" in base.columns and base["Data do Pedido"].notna().any():
-            ref_date = pd.to_datetime(base["Data do Pedido"]).max()
-        elif "Data / Mês" in base.columns and base["Data / Mês"].notna().any():
-            ref_date = pd.to_datetime(base["Data / Mês"]).max()
-        else:
-            ref_date = pd.Timestamp.today().normalize()
-
-    if "Data do Pedido" in base.columns and base["Data do Pedido"].notna().any():
-        last_buy = base.groupby("Nome Cliente")["Data do Pedido"].max().rename("UltimaCompra")
-    else:
-        last_buy = base.groupby("Nome Cliente")["Data / Mês"].max().rename("UltimaCompra")
-
-    freq = base.groupby("Nome Cliente")["Pedido"].nunique().rename("Frequencia") if "Pedido" in base.columns else base.groupby("Nome Cliente").size().rename("Frequencia")
-    val = base.groupby("Nome Cliente")["Valor Pedido R$"].sum().rename("Valor") if "Valor Pedido R$" in base.columns else None
+@st.cache_data(max_entries=32, show_spinner=False)
+def cached_rfm(key, filter_key, ref_date, tiers, _df):
+    return compute_rfm(_df, ref_date=ref_date, tiers=tiers)
 
-    rfm = pd.concat([last_buy, freq, val], axis=1)
-    rfm["RecenciaDias"] = (pd.to_datetime(ref_date) - pd.to_datetime(rfm["UltimaCompra"])).dt.days
-
-    def safe_qcut(s, labels):
-        try:
-            return pd.qcut(s.rank(method="first"), q=len(labels), labels=labels)
-        except Exception:
-            return pd.Series([labels[len(labels)//2]]*len(s), index=s.index)
-
-    rfm["R_Score"] = safe_qcut(-rfm["RecenciaDias"].fillna(rfm["RecenciaDias"].max()), labels=[1,2,3])
-    rfm["F_Score"] = safe_qcut(rfm["Frequencia"].fillna(0), labels=[1,2,3])
-    rfm["M_Score"] = safe_qcut(rfm["Valor"].fillna(0), labels=[1,2,3])
-    rfm["Score"] = rfm[["R_Score","F_Score","M_Score"]].astype(int).sum(axis=1)
-
-    def seg(row):
-        r,f,m = int(row["R_Score"]), int(row["F_Score"]), int(row["M_Score"])
-        if r>=3 and f>=3 and m>=3: return "Campeões"
-        if f>=3 and r>=2: return "Leais"
-        if r==1 and m>=2: return "Em risco"
-        if r==1 and f==1: return "Perdidos"
-        return "Oportunidades"
-    rfm["Segmento"] = rfm.apply(seg, axis=1)
-    rfm = rfm.sort_values(["Score","Valor","Frequencia"], ascending=[False,False,False]).reset_index()
-    rfm.rename(columns={"index":"Nome Cliente"}, inplace=True)
-    return rfm
-
-with tab_rfm:
+@profiled_fragment
+def render_rfm():
     st.subheader("Clientes – RFM (Recência, Frequência, Valor)")
     ref_date = pd.to_datetime(d_fim) if d_fim is not None else None
-    rfm = compute_rfm(flt, ref_date=ref_date)
+    escala = st.radio("Escala dos scores", ["Tercis (1–3)", "Quintis (1–5)"], horizontal=True)
+    tiers = 5 if escala.startswith("Quintis") else 3
+    with PROF.stage("compute_rfm", rows_in=len(flt)) as rec:
+        rfm = cached_rfm(wb_key, tuple(filters.items()), ref_date, tiers, flt)
+        rec["linhas_out"] = len(rfm)
     segs = sorted(rfm["Segmento"].unique())
     pick = st.multiselect("Segmentos", segs, default=segs)
     view = rfm[rfm["Segmento"].isin(pick)]
@@ -317,38 +417,42 @@ with tab_rfm:
     c3.metric("Mediana de Valor (R$)", fmt_money(np.nanmedian(view["Valor"])) if len(view)>0 else "-")
 
     cols = ["Nome Cliente","RecenciaDias","Frequencia","Valor","R_Score","F_Score","M_Score","Score","Segmento"]
-    display_table(view[cols], money_cols=["Valor"], int_cols=["RecenciaDias","Frequencia","Score"])
+    display_table(view[cols], money_cols=["Valor"], int_cols=["RecenciaDias","Frequencia","Score"], page_size=50, key="rfm")
 
     # Scatter F x Valor
     try:
-        scat = alt.Chart(view.reset_index(drop=True)).mark_circle(size=70).encode(
-            x=alt.X("Frequencia:Q", title="Frequência"),
-            y=alt.Y("Valor:Q", title="Valor (R$)"),
+        scat = scatter_chart(
+            view[["Nome Cliente","Frequencia","Valor","RecenciaDias","Segmento"]], "Frequencia", "Valor", "Frequência", "Valor (R$)",
+            tooltip=["Nome Cliente","Frequencia", alt.Tooltip("Valor:Q", format=",.0f"), "RecenciaDias","Segmento"],
             color=alt.Color("Segmento:N"),
-            tooltip=["Nome Cliente","Frequencia", alt.Tooltip("Valor:Q", format=",.0f"), "RecenciaDias","Segmento"]
-        ).properties(height=420)
-        st.altair_chart(scat, use_container_width=True)
+        )
+        show_chart(scat, use_container_width=True)
     except Exception:
         pass
 
 # ---------------- Rentabilidade ----------------
-with tab_profit:
+@profiled_fragment
+def render_profit():
     st.subheader("Rentabilidade – Lucro e Margem")
     c1, c2, c3, c4 = st.columns(4)
-    c1.metric("Lucro Bruto Total", fmt_money(flt["Lucro Bruto"].sum()) if "Lucro Bruto" in flt.columns else "-")
-    if "Valor Pedido R$" in flt.columns and flt["Valor Pedido R$"].sum()>0:
-        margem_total = 100.0*flt["Lucro Bruto"].sum()/flt["Valor Pedido R$"].sum()
+    c1.metric("Lucro Bruto Total", fmt_money(lucro) if "Lucro Bruto" in flt.columns else "-")
+    if "Valor Pedido R$" in flt.columns and fat>0:
+        margem_total = 100.0*lucro/fat
         c2.metric("Margem Bruta Total", fmt_pct(margem_total))
     else:
         c2.metric("Margem Bruta Total", "-")
-    c3.metric("Ticket de Margem", fmt_money(flt["Lucro Bruto"].sum()/flt["Pedido"].nunique()) if "Pedido" in flt.columns and flt["Pedido"].nunique()>0 else "-")
-    c4.metric("% Linhas Negativas", fmt_pct(100.0*(flt["Lucro Bruto"]<0).mean()) if "Lucro Bruto" in flt.columns and len(flt)>0 else "-")
+    c3.metric("Ticket de Margem", fmt_money(lucro/n_ped) if "Pedido" in flt.columns and n_ped>0 else "-")
+    if "Lucro Bruto" in flt.columns and len(flt)>0:
+        n_rows, _, n_neg = row_counts()
+        c4.metric("% Linhas Negativas", fmt_pct(100.0*n_neg/n_rows))
+    else:
+        c4.metric("% Linhas Negativas", "-")
 
     if {"Nome Cliente","Lucro Bruto"}.issubset(flt.columns):
         st.markdown("#### Top 20 – **Clientes** por Lucro Bruto")
-        top_cli = flt.groupby("Nome Cliente", as_index=False)["Lucro Bruto"].sum().sort_values("Lucro Bruto", ascending=False).head(20)
+        top_cli = group_sum("Nome Cliente", ["Lucro Bruto"]).sort_values("Lucro Bruto", ascending=False).head(20)
         display_table(top_cli, money_cols=["Lucro Bruto"])
-        st.altair_chart(
+        show_chart(
             alt.Chart(top_cli).mark_bar().encode(
                 x=alt.X("Lucro Bruto:Q", title="Lucro Bruto (R$)"),
                 y=alt.Y("Nome Cliente:N", sort="-x"),
@@ -359,9 +463,9 @@ with tab_profit:
 
     if {"ITEM","Lucro Bruto"}.issubset(flt.columns):
         st.markdown("#### Top 20 – **SKUs** por Lucro Bruto")
-        top_sku = flt.groupby("ITEM", as_index=False)["Lucro Bruto"].sum().sort_values("Lucro Bruto", ascending=False).head(20)
+        top_sku = group_sum("ITEM", ["Lucro Bruto"]).sort_values("Lucro Bruto", ascending=False).head(20)
         display_table(top_sku, money_cols=["Lucro Bruto"])
-        st.altair_chart(
+        show_chart(
             alt.Chart(top_sku).mark_bar().encode(
                 x=alt.X("Lucro Bruto:Q", title="Lucro Bruto (R$)"),
                 y=alt.Y("ITEM:N", sort="-x"),
@@ -372,67 +476,71 @@ with tab_profit:
 
     if {"Representante","Lucro Bruto","Valor Pedido R$"}.issubset(flt.columns):
         st.markdown("#### Margem por Representante")
-        por_rep = flt.groupby("Representante", as_index=False).agg({"Lucro Bruto":"sum","Valor Pedido R$":"sum"})
+        por_rep = group_sum("Representante", ["Lucro Bruto","Valor Pedido R$"])
         por_rep["Margem %"] = np.where(por_rep["Valor Pedido R$"]>0, 100.0*por_rep["Lucro Bruto"]/por_rep["Valor Pedido R$"], np.nan)
         por_rep = por_rep.sort_values("Lucro Bruto", ascending=False).head(20)
         display_table(por_rep, money_cols=["Lucro Bruto","Valor Pedido R$"], pct_cols=["Margem %"])
 
     if {"Nome Cliente","Valor Pedido R$","Lucro Bruto"}.issubset(flt.columns):
         st.markdown("#### Dispersão – Valor x Margem (%) por Cliente")
-        disp = flt.groupby("Nome Cliente", as_index=False).agg({"Valor Pedido R$":"sum","Lucro Bruto":"sum"})
+        disp = group_sum("Nome Cliente", ["Valor Pedido R$","Lucro Bruto"])
         disp["Margem %"] = np.where(disp["Valor Pedido R$"]>0, 100.0*disp["Lucro Bruto"]/disp["Valor Pedido R$"], np.nan)
-        st.altair_chart(
-            alt.Chart(disp).mark_circle(size=70).encode(
-                x=alt.X("Valor Pedido R$:Q", title="Faturamento (R$)"),
-                y=alt.Y("Margem %:Q", title="Margem (%)"),
-                tooltip=["Nome Cliente", alt.Tooltip("Valor Pedido R$:Q", format=",.0f"), alt.Tooltip("Margem %:Q", format=",.1f")]
-            ).properties(height=420),
+        show_chart(
+            scatter_chart(
+                disp[["Nome Cliente","Valor Pedido R$","Margem %"]], "Valor Pedido R$", "Margem %", "Faturamento (R$)", "Margem (%)",
+                tooltip=["Nome Cliente", alt.Tooltip("Valor Pedido R$:Q", format=",.0f"), alt.Tooltip("Margem %:Q", format=",.1f")],
+            ),
             use_container_width=True
         )
 
     if {"UF","Lucro Bruto","Valor Pedido R$"}.issubset(flt.columns):
         st.markdown("#### Margem por UF")
-        por_uf = flt.groupby("UF", as_index=False).agg({"Lucro Bruto":"sum","Valor Pedido R$":"sum"})
+        por_uf = group_sum("UF", ["Lucro Bruto","Valor Pedido R$"])
         por_uf["Margem %"] = np.where(por_uf["Valor Pedido R$"]>0, 100.0*por_uf["Lucro Bruto"]/por_uf["Valor Pedido R$"], np.nan)
         display_table(por_uf.sort_values("Margem %", ascending=False), money_cols=["Lucro Bruto","Valor Pedido R$"], pct_cols=["Margem %"])
 
     if "Lucro Bruto" in flt.columns:
         st.markdown("#### Auditoria – Linhas com Margem Negativa")
-        neg = flt[flt["Lucro Bruto"] < 0].copy()
+        neg = flt[flt["Lucro Bruto"] < 0]
         st.caption(f"{len(neg):,}".replace(",", ".") + " linhas com margem negativa no filtro atual.")
         cols_show = [c for c in ["Nome Cliente","Pedido","ITEM","Representante","UF","Valor Pedido R$","Custo","Custo Total","Lucro Bruto","Margem %","Data do Pedido","Data / Mês"] if c in neg.columns]
-        display_table(neg[cols_show], money_cols=["Valor Pedido R$","Custo","Custo Total","Lucro Bruto"], pct_cols=["Margem %"])
+        display_table(neg[cols_show], money_cols=["Valor Pedido R$","Custo","Custo Total","Lucro Bruto"], pct_cols=["Margem %"], page_size=50, key="neg")
 
 # ---------------- Clientes ----------------
-with tab_cli:
+@profiled_fragment
+def render_cli():
     st.subheader("Clientes – Faturamento")
     if {"Nome Cliente","Valor Pedido R$"}.issubset(flt.columns):
-        top_cli = flt.groupby("Nome Cliente", as_index=False)["Valor Pedido R$"].sum().sort_values("Valor Pedido R$", ascending=False)
+        top_cli = group_sum("Nome Cliente", ["Valor Pedido R$"]).sort_values("Valor Pedido R$", ascending=False)
         display_table(top_cli.head(50), money_cols=["Valor Pedido R$"])
 
 # ---------------- Produtos ----------------
-with tab_sku:
+@profiled_fragment
+def render_sku():
     st.subheader("Produtos – Faturamento")
     if {"ITEM","Valor Pedido R$"}.issubset(flt.columns):
-        top_sku = flt.groupby("ITEM", as_index=False)["Valor Pedido R$"].sum().sort_values("Valor Pedido R$", ascending=False)
+        top_sku = group_sum("ITEM", ["Valor Pedido R$"]).sort_values("Valor Pedido R$", ascending=False)
         display_table(top_sku.head(100), money_cols=["Valor Pedido R$"])
 
 # ---------------- Representantes ----------------
-with tab_rep:
+@profiled_fragment
+def render_rep():
     st.subheader("Representantes – Faturamento")
     if {"Representante","Valor Pedido R$"}.issubset(flt.columns):
-        por_rep_fat = flt.groupby("Representante", as_index=False)["Valor Pedido R$"].sum().sort_values("Valor Pedido R$", ascending=False)
+        por_rep_fat = group_sum("Representante", ["Valor Pedido R$"]).sort_values("Valor Pedido R$", ascending=False)
         display_table(por_rep_fat.head(100), money_cols=["Valor Pedido R$"])
 
 # ---------------- Geografia ----------------
-with tab_geo:
+@profiled_fragment
+def render_geo():
     st.subheader("Geografia – Faturamento por UF")
     if {"UF","Valor Pedido R$"}.issubset(flt.columns):
-        por_uf_fat = flt.groupby("UF", as_index=False)["Valor Pedido R$"].sum().sort_values("Valor Pedido R$", ascending=False)
+        por_uf_fat = group_sum("UF", ["Valor Pedido R$"]).sort_values("Valor Pedido R$", ascending=False)
         display_table(por_uf_fat, money_cols=["Valor Pedido R$"])
 
 # ---------------- Operacional ----------------
-with tab_ops:
+@profiled_fragment
+def render_ops():
     st.subheader("Operacional – Lead Time & Atraso")
     c1, c2 = st.columns(2)
     if "LeadTime (dias)" in flt.columns:
@@ -443,33 +551,142 @@ with tab_ops:
                 display_table(desc.to_frame("LeadTime (dias)").T, int_cols=["count","min","max"])
     if "Atrasado / No prazo" in flt.columns and "Pedido" in flt.columns:
         with c2:
-            atrasos = flt.groupby("Atrasado / No prazo", as_index=False)["Pedido"].nunique().rename(columns={"Pedido":"Qtde Pedidos"})
+            atrasos = flt.groupby("Atrasado / No prazo", as_index=False, observed=True)["Pedido"].nunique().rename(columns={"Pedido":"Qtde Pedidos"})
             display_table(atrasos, int_cols=["Qtde Pedidos"])
 
 # ---------------- Pareto / ABC ----------------
-with tab_pareto:
-    st.subheader("Pareto 80/20 e Curva ABC (Faturamento)")
-    if "Valor Pedido R$" in flt.columns:
-        if "Nome Cliente" in flt.columns:
-            g = flt.groupby("Nome Cliente", as_index=False)["Valor Pedido R$"].sum().sort_values("Valor Pedido R$", ascending=False)
-            g["%Acum"] = 100 * g["Valor Pedido R$"].cumsum() / g["Valor Pedido R$"].sum()
-            g["Classe"] = g["%Acum"].apply(lambda p: "A" if p<=80 else ("B" if p<=95 else "C"))
-            display_table(g.head(200), money_cols=["Valor Pedido R$"], pct_cols=["%Acum"])
-        if "ITEM" in flt.columns:
-            s = flt.groupby("ITEM", as_index=False)["Valor Pedido R$"].sum().sort_values("Valor Pedido R$", ascending=False)
-            s["%Acum"] = 100 * s["Valor Pedido R$"].cumsum() / s["Valor Pedido R$"].sum()
-            s["Classe"] = s["%Acum"].apply(lambda p: "A" if p<=80 else ("B" if p<=95 else "C"))
-            display_table(s.head(300), money_cols=["Valor Pedido R$"], pct_cols=["%Acum"])
+# Classes vêm do cache do motor (por dimensão, medida e estado de filtro),
+# compartilhado entre sessões: a aba só formata resultados já calculados.
+ABC_DIM_LABELS = {"Nome Cliente": "Cliente", "ITEM": "SKU", "Representante": "Representante", "UF": "UF"}
+ABC_MEASURE_LABELS = {"Faturamento": "Valor Pedido R$", "Lucro Bruto": "Lucro Bruto"}
+
+@profiled_fragment
+def render_pareto():
+    st.subheader("Pareto 80/20 e Curvas ABC/XYZ")
+    dims = [d for d in ABC_DIMS if d in flt.columns]
+    measures = [k for k, c in ABC_MEASURE_LABELS.items() if c in flt.columns]
+    if not dims or not measures:
+        st.info("Sem colunas para a classificação ABC.")
+        return
+    c1, c2 = st.columns(2)
+    dim = c1.selectbox("Dimensão", dims, format_func=ABC_DIM_LABELS.get, key="abc_dim")
+    measure = ABC_MEASURE_LABELS[c2.radio("Medida", measures, horizontal=True, key="abc_medida")]
+    with PROF.stage("abc_xyz", rows_in=len(flt)):
+        tbl = engine.classes(dim, measure, **filters)
+        count, share = abc_xyz_matrix(tbl, measure)
+    if not len(tbl):
+        st.info("Sem dados no filtro atual.")
+        return
+    cv_cuts = [f"{c:.1f}".replace(".", ",") for c in XYZ_CUTS]
+    st.caption(f"ABC: A até {ABC_CUTS[0]:.0f}% acumulado de {measure}, B até {ABC_CUTS[1]:.0f}%, C o resto. "
+               f"XYZ pelo coeficiente de variação do faturamento mensal: X até {cv_cuts[0]}, "
+               f"Y até {cv_cuts[1]}, Z acima ou sem faturamento.")
+    display_table(tbl, money_cols=[measure], pct_cols=["%Part","%Acum"], page_size=50, key="abc")
+
+    st.markdown("#### Matriz ABC × XYZ")
+    m1, m2 = st.columns(2)
+    with m1:
+        st.caption(f"{ABC_DIM_LABELS[dim]}s por classe")
+        display_table(count.rename_axis("ABC").reset_index(), int_cols=list(XYZ_LABELS))
+    with m2:
+        st.caption(f"% de {measure} por classe")
+        display_table(share.rename_axis("ABC").reset_index(), pct_cols=list(XYZ_LABELS))
+
+    if {"Nome Cliente","ITEM"}.issubset(flt.columns):
+        st.markdown("#### Classe do cliente × classe do SKU")
+        with PROF.stage("abc_cruzada", rows_in=len(flt)):
+            cross = engine.class_cross(measure, **filters)
+        if cross is not None:
+            st.caption(f"{measure} por classe ABC do cliente e do SKU")
+            display_table(cross.rename_axis("Classe").reset_index(), money_cols=list(cross.columns))
 
 # ---------------- Export ----------------
-with tab_export:
+# O arquivo só é gerado ao clicar em "Gerar arquivo", gravado em blocos num
+# temporário (memória estável) e reaproveitado enquanto o filtro não mudar.
+# O download é diferido (Streamlit >= 1.52): o arquivo só é lido ao clicar em
+# "Baixar"; em versões anteriores o botão recebe o arquivo aberto. Arquivos
+# sem uso há mais que o TTL de sessão são apagados na próxima visita à aba.
+EXPORT_DIR = Path(tempfile.gettempdir()) / "brasforma_export"
+EXPORT_TTL = STORE_SESSION_TTL
+DEFERRED_DOWNLOAD = tuple(int(x) for x in st.__version__.split(".")[:2]) >= (1, 52)
+
+def sweep_exports(now=None):
+    now = time.time() if now is None else now
+    for p in EXPORT_DIR.glob("brasforma_*"):
+        try:
+            if now - p.stat().st_mtime > EXPORT_TTL:
+                p.unlink()
+        except OSError:
+            pass  # já removido por outra sessão
+
+def read_export(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "CSV compactado (.gz)": ("csv.gz", "application/gzip"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "Excel (.xlsx)": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+@profiled_fragment
+def render_export():
     st.subheader("Exportar")
-    st.download_button("Baixar CSV filtrado", data=flt.to_csv(index=False).encode("utf-8-sig"), file_name="brasforma_filtrado.csv", mime="text/csv")
+    formats = [f for f in EXPORT_FORMATS if f != "Parquet" or pq is not None]
+    label = st.selectbox("Formato", formats)
+    ext, mime = EXPORT_FORMATS[label]
+    if ext == "xlsx" and len(flt) > XLSX_MAX_ROWS:
+        st.warning(f"O Excel comporta {fmt_int(XLSX_MAX_ROWS)} linhas; o arquivo será truncado.")
+    key = (wb_key, tuple(filters.items()), ext)
+    sweep_exports()
+    ready = st.session_state.get("export")
+    if ready is not None and not os.path.exists(ready["path"]):
+        ready = st.session_state["export"] = None  # expirou
+    if ready is None or ready["key"] != key:
+        if st.button("Gerar arquivo"):
+            if ready is not None and os.path.exists(ready["path"]):
+                os.remove(ready["path"])
+            EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+            fd, path = tempfile.mkstemp(prefix="brasforma_", suffix="." + ext, dir=EXPORT_DIR)
+            os.close(fd)
+            with st.spinner("Gerando arquivo..."), PROF.stage("write_export", rows_in=len(flt)):
+                write_export(flt, ext, path)
+            st.session_state["export"] = ready = {"key": key, "path": path}
+    if ready is not None and ready["key"] == key:
+        os.utime(ready["path"])  # em uso: renova o TTL
+        if DEFERRED_DOWNLOAD:
+            st.download_button(f"Baixar {label}", data=functools.partial(read_export, ready["path"]),
+                               file_name=f"brasforma_filtrado.{ext}", mime=mime)
+        else:
+            with open(ready["path"], "rb") as f:
+                st.download_button(f"Baixar {label}", data=f, file_name=f"brasforma_filtrado.{ext}", mime=mime)
     with st.expander("Prévia dos dados filtrados"):
-        st.dataframe(flt)
+        page_size = 100
+        n_pages = max(1, -(-len(flt) // page_size))
+        page = int(st.number_input("Página", min_value=1, max_value=n_pages, value=1, step=1))
+        st.caption(f"{fmt_int(len(flt))} linhas · página {fmt_int(page)} de {fmt_int(n_pages)}")
+        st.dataframe(with_lazy_cols(flt.iloc[(page-1)*page_size : page*page_size]))
+
+RENDER = dict(zip(VIEWS, [render_exec, render_rfm, render_profit, render_cli, render_sku, render_rep, render_geo, render_ops, render_pareto, render_export]))
+RENDER[view]()
 
 # Rodapé de governança de cálculo
 if qty_col:
     st.caption(f"✓ Custo calculado como **unitário × quantidade**. Coluna de quantidade: **{qty_col}**.")
 else:
     st.caption("! Atenção: coluna de quantidade não identificada — usando Custo como total.")
+
+finish_profile(PROF)
+if st.sidebar.toggle("Painel de performance", help="Tempo, linhas e memória por etapa. As etapas também vão para o log em JSON."):
+    with st.sidebar.expander("Performance", expanded=True):
+        def stage_table(stages):
+            out = stages.assign(etapa=["· " * n + e for n, e in zip(stages["nivel"], stages["etapa"])])
+            out = out.astype({"linhas_in": "Int64", "linhas_out": "Int64"})
+            return out[["etapa","ms","linhas_in","linhas_out","mem_delta_mb"]].round(1)
+        st.caption(f"Última execução: {fmt_int(PROF.total_ms)} ms")
+        st.dataframe(stage_table(PROF.frame()), hide_index=True, use_container_width=True)
+        hist = st.session_state["perf_hist"]
+        st.caption("Execuções mais lentas da sessão")
+        pick = st.selectbox("Detalhar", range(len(hist)),
+                            format_func=lambda i: f"{hist[i]['inicio'][11:]} · {hist[i]['tipo']} · {fmt_int(hist[i]['total_ms'])} ms · {hist[i]['etapa_mais_lenta']}")
+        st.dataframe(stage_table(hist[pick]["etapas"]), hide_index=True, use_container_width=True)